@@ -0,0 +1,70 @@
+"""Static assets (page backgrounds), prepared once per process
+
+Backgrounds are resized to BG_MAX_WIDTH and re-encoded as WebP (if Pillow is available)
+and inlined as a data uri, encoded once.
+The pinned streamlit (requirements.txt) has no static file serving; on streamlit >= 1.18
+with server.enableStaticServing set the css references app/static/<file> instead,
+the browser caches it and reruns send only a short <style> block.
+"""
+import os
+import base64
+import functools
+
+import streamlit as st
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT_DIR, 'static')
+BG_MAX_WIDTH = 1920
+WEBP_QUALITY = 80
+
+
+def static_serving() -> bool:
+    try:
+        return bool(st.get_option('server.enableStaticServing'))
+    except Exception:
+        return False
+
+def _prepare(path:str) -> str:
+    """resized WebP copy of path in STATIC_DIR, path itself without Pillow"""
+    if Image is None:
+        return path
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    target = os.path.join(STATIC_DIR, os.path.splitext(os.path.basename(path))[0] + '.webp')
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+        return target
+    with Image.open(path) as image:
+        if image.width > BG_MAX_WIDTH:
+            image = image.resize((BG_MAX_WIDTH, round(image.height * BG_MAX_WIDTH / image.width)))
+        tmp = f'{target}.{os.getpid()}.tmp'
+        image.save(tmp, 'WEBP', quality=WEBP_QUALITY)
+    os.replace(tmp, target)
+    return target
+
+@functools.lru_cache(maxsize=None)
+def _background_css(path:str, mtime:float, static:bool) -> str:
+    asset = _prepare(path)
+    if static and os.path.dirname(asset) == STATIC_DIR:
+        url = f'app/static/{os.path.basename(asset)}'
+    else:
+        ext = os.path.splitext(asset)[1].lstrip('.')
+        with open(asset, 'rb') as file:
+            url = f'data:image/{ext};base64,{base64.b64encode(file.read()).decode()}'
+    return f"""
+         <style>
+         .stApp {{
+             background: url({url});
+             background-size: cover
+         }}
+         </style>
+         """
+
+def background_css(main_bg:str) -> str:
+    """<style> block setting main_bg as the page background, cached per file version"""
+    path = os.path.join(ROOT_DIR, main_bg)
+    return _background_css(path, os.path.getmtime(path), static_serving())
@@ -0,0 +1,193 @@
+"""Microbenchmarks: loader transforms, page aggregations, chart builders
+
+Synthetic raw pages follow the sheet schemas of ingest.py (russian headers,
+'1 234.50' / '1,234.50' numbers, %d.%m.%Y dates).
+
+    python bench.py --sizes 1000,100000,1000000 --output bench.json
+    python bench.py --output bench.json --baseline bench_baseline.json      # exit 1 on regressions
+    python bench.py --output bench_baseline.json                            # store a new baseline
+
+Timings are best / median of --repeat runs, in seconds.
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+SIZES = [1_000, 10_000, 100_000]
+REPEAT = 5
+THRESHOLD = 1.25 # best time / baseline best time above this is a regression
+
+METERS = [('ХВС', 'кухня'), ('ГВС', 'кухня'), ('ХВС', 'ванная'), ('ГВС', 'ванная'), ('ЭЛ.ЭНЕРГИЯ', 'квартира'), ('ГАЗ', 'квартира')]
+SERVICES = ['вода', 'электричество', 'газ', 'домофон', 'интернет', 'капремонт', 'вывоз мусора', 'отопление']
+SUPPLIERS = ['Мосводоканал', 'Мосэнергосбыт', 'Мосгаз', 'МГТС', 'Фонд капремонта']
+GROUPS = ['Семья', 'Родители', 'Морозовы']
+
+
+# synthetic raw pages, all values are strings as in batchGet
+def _dates(rng:np.random.Generator, n:int, years:int=20) -> pd.Series:
+    days = np.sort(rng.integers(0, years * 365, n))
+    labels = pd.date_range('2003-01-01', periods=years * 365, freq='D').strftime('%d.%m.%Y').values.astype(object)
+    return pd.Series(labels[days]) # formatted once per day, not per row
+
+def _amounts(rng:np.random.Generator, n:int, low:float, high:float) -> pd.Series:
+    """'1 234.50' and '1,234.50' (thousands separators) mixed with plain '234.50'"""
+    values = pd.Series(rng.uniform(low, high, n).round(2))
+    formatted = values.map('{:,.2f}'.format)
+    spaced = rng.random(n) < 0.5
+    formatted[spaced] = formatted[spaced].str.replace(',', ' ', regex=False)
+    return formatted
+
+def meters_page(n:int, seed:int=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    meter = rng.integers(0, len(METERS), n)
+    consumption = rng.uniform(0, 500, n).round(1)
+    return pd.DataFrame({
+        'Дата': _dates(rng, n),
+        'счетчик': np.array([m for m, _ in METERS], dtype=object)[meter],
+        'место': np.array([p for _, p in METERS], dtype=object)[meter],
+        'показания': _amounts(rng, n, 0, 99_999),
+        'потребление': pd.Series(consumption).map('{:.1f}'.format),
+    })
+
+def payments_page(n:int, seed:int=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    commision = _amounts(rng, n, 0, 50)
+    commision[rng.random(n) < 0.7] = ''
+    return pd.DataFrame({
+        'Дата': _dates(rng, n),
+        'услуга': np.array(SERVICES, dtype=object)[rng.integers(0, len(SERVICES), n)],
+        'поставщик': np.array(SUPPLIERS, dtype=object)[rng.integers(0, len(SUPPLIERS), n)],
+        'сумма': _amounts(rng, n, 10, 15_000),
+        'комиссия': commision,
+    })
+
+def phone_numbers(n:int) -> List[str]:
+    """about 10 years of monthly bills per number, 1000 numbers at most"""
+    return [f'+7916{i:07d}' for i in range(min(max(n // 120, 1), 1000))]
+
+def phone_bills_page(n:int, seed:int=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    numbers = phone_numbers(n)
+    return pd.DataFrame({
+        'Дата': _dates(rng, n, years=10),
+        'Номер': np.array(numbers, dtype=object)[rng.integers(0, len(numbers), n)],
+        'Сумма': _amounts(rng, n, 100, 2_500),
+    })
+
+def phone_match_page(n:int, seed:int=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    numbers = phone_numbers(n)
+    return pd.DataFrame({
+        'Номер': numbers,
+        'владелец': [f'владелец {i}' for i in range(len(numbers))],
+        'группа': np.array(GROUPS, dtype=object)[rng.integers(0, len(GROUPS), len(numbers))],
+        'активен': np.where(rng.random(len(numbers)) < 0.8, '1', ''),
+    })
+
+
+# timing
+def measure(func:Callable[[], object], repeat:int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'best_s': min(times), 'median_s': float(np.median(times)), 'repeat': repeat}
+
+def cases(n:int) -> Dict[str, Callable[[], object]]:
+    """name -> callable, inputs prepared outside of the timed calls"""
+    from loaders import meters_from_gs, payments_from_gs, phones_from_gs, METER_GROUPS
+    from rollups import MetersCube, PaymentsAggregates
+    from common import fig_line_area, fig_bar
+
+    raw_meters, raw_payments = meters_page(n), payments_page(n)
+    raw_bills, raw_matches = phone_bills_page(n), phone_match_page(n)
+    df_meters = meters_from_gs(raw_meters.copy())
+    df_payments = payments_from_gs(raw_payments.copy())
+    df_phones, _ = phones_from_gs(raw_bills.copy(), raw_matches.copy())
+    cube = MetersCube(df_meters, METER_GROUPS)
+    years = (min(cube.years()), max(cube.years()))
+    water_by_month = cube.meters_by_month('water', years)
+    water_by_month_num = cube.by_month_num('water', years)
+
+    def meters_page_queries():
+        for group in METER_GROUPS:
+            cube.by_month(group, years), cube.by_year(group, years), cube.by_month_num(group, years)
+            cube.meters_by_month(group, years), cube.meters_by_year(group, years), cube.meters_by_month_num(group, years)
+
+    def phone_page_aggregates():
+        df_phones.groupby(['group', 'date_eom'], observed=True)['summ'].sum()
+        df_phones.groupby(['number', 'year'], observed=True)['summ'].sum()
+
+    # figures uncached: __wrapped__ is the builder behind cached_figure
+    return {
+        'transform:meters': lambda: meters_from_gs(raw_meters.copy()),
+        'transform:payments': lambda: payments_from_gs(raw_payments.copy()),
+        'transform:phones': lambda: phones_from_gs(raw_bills.copy(), raw_matches.copy()),
+        'aggregate:meters_cube': lambda: MetersCube(df_meters, METER_GROUPS),
+        'aggregate:meters_queries': meters_page_queries,
+        'aggregate:payments': lambda: PaymentsAggregates(df_payments),
+        'aggregate:phones': phone_page_aggregates,
+        'figure:fig_line_area': lambda: fig_line_area.__wrapped__(water_by_month, x='date_eom', y='consumption',
+                                                                   color='meter', type='line', title='bench'),
+        'figure:fig_bar': lambda: fig_bar.__wrapped__(water_by_month_num, x='month_num', y='consumption', title='bench'),
+    }
+
+def run(sizes:List[int], repeat:int, only:str=None) -> dict:
+    results = []
+    for n in sizes:
+        for name, func in cases(n).items():
+            if only and not name.startswith(only):
+                continue
+            result = {'case': name, 'rows': n, **measure(func, repeat)}
+            results.append(result)
+            print(f"{name:<28} {n:>10} rows  best {result['best_s']:.4f} s  median {result['median_s']:.4f} s", file=sys.stderr)
+    return {
+        'meta': {'ts': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                 'pandas': pd.__version__, 'numpy': np.__version__, 'machine': platform.machine(), 'repeat': repeat},
+        'results': results,
+    }
+
+def compare(report:dict, baseline:dict, threshold:float=THRESHOLD) -> List[dict]:
+    """cases slower than threshold x baseline (best times), same case and rows"""
+    base = {(r['case'], r['rows']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        old = base.get((result['case'], result['rows']))
+        if old is None or old['best_s'] <= 0:
+            continue
+        ratio = result['best_s'] / old['best_s']
+        if ratio > threshold:
+            regressions.append({'case': result['case'], 'rows': result['rows'], 'ratio': ratio,
+                                'best_s': result['best_s'], 'baseline_best_s': old['best_s']})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='rows per page, e.g. 1000,1000000,10000000')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--only', default=None, help='case prefix, e.g. transform: or figure:fig_bar')
+    parser.add_argument('--output', default='bench.json', help='machine-readable results (json)')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='allowed slowdown, best / baseline best')
+    args = parser.parse_args()
+
+    report = run([int(size) for size in args.sizes.split(',')], args.repeat, args.only)
+    if args.baseline:
+        with open(args.baseline) as file:
+            report['regressions'] = compare(report, json.load(file), args.threshold)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, ensure_ascii=False, indent=1)
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['case']} {regression['rows']} rows: x{regression['ratio']:.2f}", file=sys.stderr)
+    sys.exit(1 if report.get('regressions') else 0)
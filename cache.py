@@ -0,0 +1,172 @@
+"""Cache policy for sheet-backed loaders: TTL + stale-while-revalidate
+
+A value is fresh for ttl seconds. After that it is still served at once
+while one background thread per key refreshes it. Missing keys are loaded
+once (single-flight): concurrent callers wait for the same load.
+Writes patch cached values in place (patch), a load or refresh that raced
+with a patch or invalidate is not stored (storable tells the load itself, e.g. to skip side effects).
+"""
+import time
+import logging
+import threading
+import contextlib
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Entry:
+    value:Any
+    loaded_at:float
+
+    def age(self) -> float:
+        return time.time() - self.loaded_at
+
+
+class SWRCache:
+    """key -> Entry, at most one load / refresh running per key"""
+    def __init__(self, refresh_context:Callable[[], Any]=None):
+        self.refresh_context = refresh_context # context manager around background refreshes
+        self.entries:Dict[Hashable, Entry] = {}
+        self.inflight:Dict[Hashable, threading.Event] = {}
+        self.refreshing = set()
+        self.versions:Dict[Hashable, int] = {} # bumped by patch / invalidate
+        self.claims:Dict[threading.Event, int] = {} # event of a load -> version at its start
+        self.local = threading.local() # version at the start of the load / refresh running in the thread
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _claim(self, key:Hashable) -> threading.Event:
+        event = self.inflight[key] = threading.Event()
+        self.claims[event] = self.versions.get(key, 0)
+        return event
+
+    def claim(self, key:Hashable) -> threading.Event:
+        """mark key as being loaded by the caller, None if it is cached or already being loaded"""
+        with self.lock:
+            if key in self.entries or key in self.inflight:
+                return None
+            return self._claim(key)
+
+    def release(self, key:Hashable, event:threading.Event, value:Any=None, loaded:bool=False) -> bool:
+        """end of a claimed load, value is stored if loaded and nothing patched / invalidated key since; True if stored"""
+        with self.lock:
+            version = self.claims.pop(event, None)
+            stored = loaded and version == self.versions.get(key, 0)
+            if stored:
+                self.entries[key] = Entry(value, time.time())
+            if self.inflight.get(key) is event:
+                del self.inflight[key]
+        event.set()
+        return stored
+
+    def storable(self, key:Hashable) -> bool:
+        """called by a load / refresh of key: its value would be stored, nothing patched / invalidated key since it started"""
+        with self.lock:
+            return getattr(self.local, 'version', None) == self.versions.get(key, 0)
+
+    def keys(self, match:Callable[[Hashable], bool]) -> List[Hashable]:
+        """cached keys and keys being loaded with match(key)"""
+        with self.lock:
+            return [key for key in set(self.entries) | set(self.inflight) if match(key)]
+
+    def put(self, key:Hashable, value:Any, version:int=None) -> bool:
+        """store value; with version: only if nothing patched / invalidated key since"""
+        with self.lock:
+            if version is not None and version != self.versions.get(key, 0):
+                return False
+            self.entries[key] = Entry(value, time.time())
+            return True
+
+    def seed(self, key:Hashable, value:Any, loaded_at:float=0.0) -> bool:
+        """store value if key is not cached or being loaded; loaded_at 0: stale at once, refreshed on the first get"""
+        with self.lock:
+            if key in self.entries or key in self.inflight:
+                return False
+            self.entries[key] = Entry(value, loaded_at)
+            return True
+
+    def patch(self, match:Callable[[Hashable], bool], update:Callable[[Any], Any]) -> List[Hashable]:
+        """replace values of matching keys by update(value), loaded_at is kept; patched keys
+        loads / refreshes of matching keys running now are not stored, they may miss the change
+        """
+        with self.lock:
+            keys = [key for key in set(self.entries) | set(self.inflight) if match(key)]
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+            entries = {key: self.entries[key] for key in keys if key in self.entries}
+        patched = {key: Entry(update(entry.value), entry.loaded_at) for key, entry in entries.items()}
+        with self.lock:
+            for key, entry in list(patched.items()):
+                if self.entries.get(key) is entries[key]:
+                    self.entries[key] = entry
+                else:
+                    del patched[key]
+        return list(patched)
+
+    def peek(self, key:Hashable) -> Entry:
+        with self.lock:
+            return self.entries.get(key)
+
+    def invalidate(self, match:Callable[[Hashable], bool]=None) -> None:
+        """drop entries (all or those with match(key)), next get loads synchronously"""
+        with self.lock:
+            for key in [key for key in set(self.entries) | set(self.inflight) if match is None or match(key)]:
+                self.entries.pop(key, None)
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key:Hashable, load:Callable[[], Any], ttl:float=None) -> Any:
+        """cached value; expired -> stale value + background refresh; missing -> load once"""
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    expired = ttl is not None and entry.age() > ttl
+                    self.hits += 1
+                    self.stale_hits += expired
+                    if expired and key not in self.refreshing:
+                        self.refreshing.add(key)
+                        version = self.versions.get(key, 0)
+                        threading.Thread(target=self._refresh, args=(key, load, version), name='cache-refresh', daemon=True).start()
+                    return entry.value
+                event = self.inflight.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self._claim(key)
+                    version = self.claims[event]
+                    break
+            event.wait()
+        value, loaded = None, False
+        self.local.version = version
+        try:
+            value = load()
+            loaded = True
+            return value
+        finally:
+            self.local.version = None
+            self.release(key, event, value, loaded)
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'items': len(self.entries), 'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+    def _refresh(self, key:Hashable, load:Callable[[], Any], version:int) -> None:
+        self.local.version = version
+        try:
+            with self.refresh_context() if self.refresh_context else contextlib.nullcontext():
+                value = load()
+            self.put(key, value, version)
+        except Exception:
+            logger.exception(f'refresh of {key[0] if isinstance(key, tuple) else key} failed, serving stale value')
+        finally:
+            self.local.version = None
+            with self.lock:
+                self.refreshing.discard(key)
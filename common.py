@@ -0,0 +1,227 @@
+"""Helpers shared by all pages: charts, auth, background. Importing has no side effects."""
+import os
+import copy
+import hmac
+import json
+import time
+import hashlib
+import secrets
+import datetime
+import functools
+import yaml
+
+from typing import List
+
+import pandas as pd
+import plotly.express as px
+import streamlit as st
+import streamlit_authenticator as stauth
+
+from figure_cache import cached_figure, FIGURE_CACHE
+from downsample import downsample_frame
+from ingest import plain_frame
+from assets import background_css
+from loaders import CACHE
+from metrics import timed, export, rerun_seconds, rerun_stages, METRICS
+
+
+WEBGL_THRESHOLD = 2000 # points in a figure
+MAX_POINTS = 1000 # points per trace
+
+AUTH_CONFIG = 'config.yaml'
+AUTH_TOKEN_TTL = 12 * 3600 # seconds a verified session skips login
+_AUTH_SECRET = secrets.token_bytes(32) # session_state lives in this process too
+
+
+def date_eom(x:datetime):
+    return (x.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+
+def st_multiselect_empty(ser:pd.Series, title:str='', default:List[str]=None) -> List[str]:
+    group_sel = st.multiselect(title, list(set(ser)), default)
+    return set(ser) if not group_sel else group_sel
+
+def color_cur_prev(cur, prev):
+    color = 'green' if cur < prev else 'red' if cur > prev else 'grey'
+    return f'color: {color}'
+
+@cached_figure
+def fig_line_area(df:pd.DataFrame, 
+            x:str, 
+            y:str, 
+            type:str = 'line', # line / area
+            color:str=None, 
+            title:str='', 
+            line_color:str=None, 
+            line_colors:List[str]=[],
+            xaxis_title:str='', 
+            yaxis_title:str='',
+            hover_name:str=None,
+            markers=True,
+            webgl_threshold:int=WEBGL_THRESHOLD,
+            max_points:int=MAX_POINTS
+            ):
+    """webgl_threshold: more points -> WebGL traces without markers
+    max_points: longer traces are downsampled (LTTB) to max_points, None -> all points
+    """
+    df = plain_frame(df)
+    if max_points:
+        # px.area stacks its traces: all of them keep the same x
+        df = downsample_frame(df, x, y, max_points, color=color, shared_x=type == 'area')
+    px_fig = px.line
+    if type == 'area':
+        px_fig = px.area
+
+    if type != 'area' and len(df) > webgl_threshold:
+        fig = px_fig(df, x=x, y=y, color=color, hover_name=hover_name, markers=False, render_mode='webgl')
+    else:
+        fig = px_fig(df, x=x, y=y, color=color, hover_name=hover_name, markers=markers)
+    if color and line_colors:
+        for i in  range(len(line_colors)):
+            fig['data'][i]['line']['color']=line_colors[i]
+    elif line_color: 
+        fig.update_traces(line_color=line_color)
+
+
+    fig.update_traces(marker=dict(size=4))
+
+    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
+    fig.update_yaxes(rangemode="tozero")
+
+    fig.update_layout({'plot_bgcolor': 'rgba(255, 255, 255, 0.3)',
+                        'paper_bgcolor': 'rgba(255, 255, 255, 0.2)',
+                     })
+
+    return fig
+
+@cached_figure
+def fig_bar(df:pd.DataFrame, 
+            x:str, 
+            y:str, 
+            color:str=None, 
+            title:str='', 
+            marker_color:str=None, 
+            color_discrete_map:dict=None,
+            xaxis_title:str='', 
+            yaxis_title:str='',
+            barmode:str='relative',
+            hover_name:str=None
+            ):
+    """bars are not downsampled: LTTB picks different x per trace, stacked / grouped bars would not add up"""
+    df = plain_frame(df)
+    # one px.bar call per cache miss
+    fig = px.bar(df, x=x, y=y, color=color, color_discrete_map=color_discrete_map if color else None,
+                 barmode=barmode, hover_name=hover_name)
+    if not color and marker_color:
+        fig.update_traces(marker_color=marker_color)
+
+    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
+    fig.update_yaxes(rangemode="tozero")
+    fig.update_layout({'plot_bgcolor': 'rgba(255, 255, 255, 0.3)',
+                    'paper_bgcolor': 'rgba(255, 255, 255, 0.2)',
+                    })
+    return fig
+
+
+
+def set_bg_hack(main_bg):
+    '''
+    A function to set an image from root folder as bg.
+    The image is prepared once per process, see assets.background_css
+
+    Returns
+    -------
+    The background.
+    '''
+    st.markdown(background_css(main_bg), unsafe_allow_html=True)
+
+
+@functools.lru_cache(maxsize=4)
+def _auth_config(path:str, mtime:float) -> dict:
+    with open(path) as file:
+        return yaml.load(file, Loader=stauth.SafeLoader)
+
+def load_auth_config(path:str=AUTH_CONFIG) -> dict:
+    """parsed config.yaml, re-read only when the file changes"""
+    return copy.deepcopy(_auth_config(path, os.path.getmtime(path)))
+
+def _sign(payload:str) -> str:
+    return hmac.new(_AUTH_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+
+def _session_token(username:str) -> str:
+    """signed (username, expiry, config version) of a verified session"""
+    payload = json.dumps([username, time.time() + AUTH_TOKEN_TTL, os.path.getmtime(AUTH_CONFIG)])
+    return f'{payload}|{_sign(payload)}'
+
+def _verified_session() -> bool:
+    """session already passed login: token signature, expiry, config version and user match"""
+    token = st.session_state.get('auth_token')
+    if not token or not st.session_state.get('authentication_status') or st.session_state.get('authenticator') is None:
+        return False
+    payload, _, signature = token.rpartition('|')
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return False
+    username, expires, config_mtime = json.loads(payload)
+    return (username == st.session_state.get('username')
+            and expires > time.time()
+            and config_mtime == os.path.getmtime(AUTH_CONFIG))
+
+def auth():
+    with timed('auth'):
+        return _auth()
+
+def _auth():
+    # auth
+    # https://blog.streamlit.io/streamlit-authenticator-part-1-adding-an-authentication-component-to-your-app/
+    # verified sessions skip config parsing, Authenticate and bcrypt
+    if _verified_session():
+        return st.session_state['authenticator']
+    st.session_state['auth_token'] = None
+
+    config = load_auth_config()
+    authenticator  = stauth.Authenticate(
+        config['credentials'],
+        config['cookie']['name'],
+        config['cookie']['key'],
+        config['cookie']['expiry_days'],
+        config['preauthorized']
+    )
+
+    st.session_state["name"], st.session_state["authentication_status"], st.session_state["username"] = authenticator.login('Войти', 'sidebar')
+    if st.session_state["authentication_status"]:
+        st.session_state['auth_token'] = _session_token(st.session_state["username"])
+        st.session_state['authenticator'] = authenticator
+    return authenticator
+
+
+# metrics
+def plotly_chart(fig, **kwargs) -> None:
+    """st.plotly_chart, timed as render (figure serialization)"""
+    with timed('render'):
+        st.plotly_chart(fig, **kwargs)
+
+def is_admin() -> bool:
+    """logged in user is in ADMINS of st.secrets"""
+    try:
+        admins = st.secrets.get('ADMINS', [])
+    except Exception:
+        return False
+    return bool(st.session_state.get('authentication_status')) and st.session_state.get('username') in admins
+
+def cache_gauges() -> dict:
+    gauges = {}
+    for name, cache in [('loader_cache', CACHE), ('figure_cache', FIGURE_CACHE)]:
+        for stat, value in cache.stats().items():
+            gauges[f'{name}_{stat}'] = value
+    return gauges
+
+def report_rerun(page:str) -> None:
+    """last line of every page: export metrics of the rerun, sidebar panel for admins"""
+    record = export(page, cache_gauges())
+    if not is_admin():
+        return
+    with st.sidebar.expander('Метрики'):
+        st.write(f'перезапуск: {rerun_seconds():.3f} с')
+        st.dataframe(pd.Series(rerun_stages(), name='с', dtype='float64').sort_values(ascending=False))
+        totals = METRICS.snapshot()
+        st.dataframe(pd.DataFrame(totals['stages']).T)
+        st.json({**totals['counters'], **record['gauges']})
@@ -0,0 +1,55 @@
+"""Shape-preserving downsampling of long series (Largest-Triangle-Three-Buckets)"""
+import numpy as np
+import pandas as pd
+
+
+def lttb_indices(x:np.ndarray, y:np.ndarray, n_out:int) -> np.ndarray:
+    """positions of the n_out points of (x, y) that keep the shape of the line, x ascending"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype('float64')
+    y = np.nan_to_num(y.astype('float64'))
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64) # n_out - 2 buckets between first and last point
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket (or the last point)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        kept[i + 1] = a
+    return kept
+
+def _numeric(ser:pd.Series) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(ser):
+        return ser.values.astype('datetime64[ns]').astype('int64')
+    return pd.to_numeric(ser, errors='coerce').values
+
+def downsample_frame(df:pd.DataFrame, x:str, y:str, max_points:int, color:str=None, shared_x:bool=False) -> pd.DataFrame:
+    """keep at most max_points rows per trace (color), row order preserved
+    shared_x: the same x values for every trace, picked on the summed series (stacked areas add up)
+    """
+    if len(df) <= max_points:
+        return df
+    if shared_x and color:
+        total = df.groupby(x, sort=True, observed=True)[y].sum()
+        if len(total) <= max_points:
+            return df
+        xs = total.index[lttb_indices(_numeric(total.index.to_series()), total.values, max_points)]
+        return df[df[x].isin(xs)]
+    groups = df.groupby(color, sort=False, observed=True).indices.values() if color else [np.arange(len(df))]
+    kept = []
+    for positions in groups:
+        if len(positions) <= max_points:
+            kept.append(positions)
+            continue
+        trace = df.iloc[positions]
+        order = np.argsort(_numeric(trace[x]), kind='stable')
+        positions = positions[order]
+        kept.append(positions[lttb_indices(_numeric(df[x].iloc[positions]), _numeric(df[y].iloc[positions]), max_points)])
+    return df.iloc[np.sort(np.concatenate(kept))]
@@ -0,0 +1,82 @@
+"""Time-series features of monthly frames: previous period, year over year, rolling mean
+
+Periods are calendar months of date_eom, not rows: the previous period of March is February
+even when an entity has no rows in February. A month without rows counts as 0
+once the entity has started (no bill, no consumption), months before its first row are unknown (NaN).
+All features of all entities are computed in one vectorized pass over (entity, month) slots.
+
+Frames with several rows per entity and month (payments) get the value of a slot on its first row
+and NaN on the others, so sums over the rows of a month stay right.
+"""
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+MONTHS_SPAN = 1 << 20 # month ordinals of an entity stay below this
+
+
+def month_ordinal(dates:pd.Series) -> np.ndarray:
+    """year * 12 + month - 1"""
+    return (dates.dt.year.to_numpy(dtype='int64') * 12 + dates.dt.month.to_numpy(dtype='int64') - 1)
+
+
+class MonthlySlots:
+    """rows of df grouped into (entity, month) slots, sorted by entity then month"""
+    def __init__(self, df:pd.DataFrame, keys:List[str], date:str='date_eom'):
+        dates = df[date]
+        self.dated = dates.notna().to_numpy()
+        entity = df.groupby(keys, sort=False, observed=True, dropna=False).ngroup().to_numpy(dtype='int64')
+        entity[~self.dated] = -1 # rows without a date: one slot of their own, no features
+        month = month_ordinal(dates.fillna(pd.Timestamp(0)))
+        self.slots, self.inverse = np.unique(entity * MONTHS_SPAN + month, return_inverse=True)
+        self.month = self.slots % MONTHS_SPAN
+        entity_of_slot = self.slots // MONTHS_SPAN
+        first_slot = np.ones(len(self.slots), dtype=bool)
+        first_slot[1:] = entity_of_slot[1:] != entity_of_slot[:-1]
+        # first month of the entity of every slot
+        self.start = self.month[first_slot][np.cumsum(first_slot) - 1]
+        self.first_row = np.zeros(len(df), dtype=bool)
+        self.first_row[np.unique(self.inverse, return_index=True)[1]] = True
+
+    def totals(self, values:pd.Series) -> np.ndarray:
+        """sum of values per slot, NaN as 0"""
+        return np.bincount(self.inverse, weights=np.nan_to_num(values.to_numpy(dtype='float64')), minlength=len(self.slots))
+
+    def lag(self, totals:np.ndarray, months:int) -> np.ndarray:
+        """total of the same entity months earlier per slot: 0 for a gap, NaN before the entity started"""
+        target = self.slots - months
+        i = np.minimum(np.searchsorted(self.slots, target), len(self.slots) - 1)
+        found = self.slots[i] == target
+        return np.where(found, totals[i], np.where(self.month - months >= self.start, 0.0, np.nan))
+
+    def rolling_mean(self, totals:np.ndarray, months:int) -> np.ndarray:
+        """mean of the last months totals (current included) per slot, the window starts no earlier than the entity"""
+        lower = np.maximum(self.month - months + 1, self.start)
+        first = np.searchsorted(self.slots, self.slots - (self.month - lower))
+        cumulative = np.r_[0.0, np.cumsum(totals)]
+        return (cumulative[np.arange(len(self.slots)) + 1] - cumulative[first]) / (self.month - lower + 1)
+
+    def to_rows(self, per_slot:np.ndarray) -> np.ndarray:
+        """value of the slot on its first row, NaN on the others"""
+        return np.where(self.first_row & self.dated, per_slot[self.inverse], np.nan)
+
+
+def period_features(df:pd.DataFrame, keys:List[str], columns:List[str], date:str='date_eom',
+                    prev:bool=True, yoy:bool=False, rolling:List[int]=()) -> pd.DataFrame:
+    """features of columns per entity (keys), aligned with df
+    prev_<column>: previous month, yoy_<column>: same month a year earlier,
+    rolling<n>_<column>: mean of the last n months
+    """
+    slots = MonthlySlots(df, keys, date)
+    features:Dict[str, np.ndarray] = {}
+    for column in columns:
+        totals = slots.totals(df[column])
+        if prev:
+            features[f'prev_{column}'] = slots.to_rows(slots.lag(totals, 1))
+        if yoy:
+            features[f'yoy_{column}'] = slots.to_rows(slots.lag(totals, 12))
+        for months in rolling:
+            features[f'rolling{months}_{column}'] = slots.to_rows(slots.rolling_mean(totals, months))
+    return pd.DataFrame(features, index=df.index)
@@ -0,0 +1,90 @@
+"""Content-addressed cache of plotly figures
+
+Key: fingerprint of the input frame + chart arguments.
+Unchanged charts come back without plotly express building them again.
+Cached figures are shared between reruns and sessions: do not mutate them.
+"""
+import os
+import hashlib
+import threading
+import functools
+
+from collections import OrderedDict
+
+import pandas as pd
+
+from metrics import timed
+
+
+def frame_fingerprint(df:pd.DataFrame) -> str:
+    """hash of values, index, column names and dtypes"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((list(df.columns), [str(dtype) for dtype in df.dtypes])).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+# the payments page builds ~164 figures per rerun (4 per supplier / service):
+# keep at least 4 page states, so toggling a filter back does not rebuild them
+FIGURE_CACHE_ITEMS = int(os.environ.get('FIGURE_CACHE_ITEMS', 1024))
+FIGURE_CACHE_BYTES = int(os.environ.get('FIGURE_CACHE_BYTES', 256 * 2**20))
+
+
+class FigureCache:
+    """LRU by number of figures and approximate bytes (memory of the input frames)"""
+    def __init__(self, max_items:int=FIGURE_CACHE_ITEMS, max_bytes:int=FIGURE_CACHE_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict() # key -> (fig, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key:str):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key:str, fig, nbytes:int) -> None:
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+            self.items[key] = (fig, nbytes)
+            self.nbytes += nbytes
+            while self.items and (len(self.items) > self.max_items or self.nbytes > self.max_bytes):
+                _, (_, old_nbytes) = self.items.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'items': len(self.items), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+
+FIGURE_CACHE = FigureCache()
+
+
+def cached_figure(fig_func):
+    """cache fig_func(df, ...) in FIGURE_CACHE"""
+    @functools.wraps(fig_func)
+    def wrapper(df:pd.DataFrame, *args, **kwargs):
+        with timed('figure'):
+            key = repr((fig_func.__qualname__, frame_fingerprint(df), args, sorted(kwargs.items())))
+            fig = FIGURE_CACHE.get(key)
+            if fig is None:
+                fig = fig_func(df, *args, **kwargs)
+                FIGURE_CACHE.put(key, fig, int(df.memory_usage(index=True, deep=True).sum()))
+            return fig
+    return wrapper
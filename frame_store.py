@@ -0,0 +1,138 @@
+"""Columnar on-disk snapshots of loader results (Feather, memory-mapped on read)
+
+A result (frame or tuple of frames) is saved as one Feather file per frame
+plus a small json with its data version (fingerprint of the frames) and loaded_at,
+the time its data was read from Sheets (a write-through save keeps the loaded_at of the patched result).
+After a restart loaders serve the snapshot at once and reconcile with Sheets in background;
+while Sheets is unreachable the snapshot keeps the pages working read-only.
+
+The store is shared by all workers of the host: fetch_lock lets one worker fetch
+while the others wait and then read its snapshot (load_fresh), one fetch per ttl per host.
+Mapped files are shared through the page cache, numeric columns without nulls are not copied.
+Needs pyarrow, without it nothing is saved or read.
+"""
+import os
+import json
+import glob
+import time
+import hashlib
+import logging
+import contextlib
+
+from typing import Any, Hashable
+
+from figure_cache import frame_fingerprint
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+try:
+    import fcntl
+except ImportError: # not posix: no host-wide lock, every worker fetches
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.snapshots'))
+SNAPSHOT_FORMAT = 4 # bump when transforms change the frames
+
+
+def _base(key:Hashable) -> str:
+    """file name prefix of key, the key itself (with credentials) is not written"""
+    name = key[0] if isinstance(key, tuple) else 'result'
+    return os.path.join(SNAPSHOT_DIR, f'{name}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}')
+
+def data_version(value:Any) -> str:
+    frames = value if isinstance(value, tuple) else (value,)
+    return hashlib.blake2b(''.join(frame_fingerprint(df) for df in frames).encode(), digest_size=16).hexdigest()
+
+def save(key:Hashable, value:Any, loaded_at:float=None) -> str:
+    """write value (frame or tuple of frames) for key, returns its data version
+    loaded_at: when value was read from Sheets, None: now
+    frames of an unchanged version are not rewritten; call under fetch_lock(key),
+    concurrent saves of a key remove each other's files
+    """
+    if feather is None:
+        return None
+    frames = value if isinstance(value, tuple) else (value,)
+    version = data_version(value)
+    base = _base(key)
+    meta = read_meta(key)
+    if meta is None or meta['version'] != version:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        for i, df in enumerate(frames):
+            path = f'{base}.{version}.{i}.feather'
+            tmp = f'{path}.{os.getpid()}.tmp'
+            feather.write_feather(df.reset_index(drop=True), tmp)
+            os.replace(tmp, path)
+    # unchanged version: only loaded_at is renewed, other workers see it is fresh
+    meta = {'format': SNAPSHOT_FORMAT, 'version': version, 'parts': len(frames),
+            'tuple': isinstance(value, tuple), 'loaded_at': time.time() if loaded_at is None else loaded_at}
+    _write_meta(key, meta)
+    for path in glob.glob(f'{glob.escape(base)}.*.feather'):
+        if f'.{version}.' not in os.path.basename(path):
+            os.remove(path)
+    return version
+
+def expire(key:Hashable) -> None:
+    """mark the snapshot of key as not fresh (loaded_at 0): load_fresh skips it, load still serves it"""
+    meta = read_meta(key)
+    if meta is None:
+        return
+    meta['loaded_at'] = 0.0
+    _write_meta(key, meta)
+
+def _write_meta(key:Hashable, meta:dict) -> None:
+    base = _base(key)
+    tmp = f'{base}.json.{os.getpid()}.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp, f'{base}.json') # the json points to the version: readers never see a half-written one
+
+def read_meta(key:Hashable) -> dict:
+    try:
+        with open(f'{_base(key)}.json') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format') == SNAPSHOT_FORMAT else None
+
+def load(key:Hashable) -> Any:
+    """snapshot of key (memory-mapped Feather), None if there is none"""
+    if feather is None:
+        return None
+    meta = read_meta(key)
+    if meta is None:
+        return None
+    base = _base(key)
+    try:
+        frames = tuple(feather.read_table(f'{base}.{meta["version"]}.{i}.feather', memory_map=True).to_pandas(split_blocks=True)
+                       for i in range(meta['parts']))
+    except Exception:
+        logger.exception(f'snapshot {base} is unreadable')
+        return None
+    return frames if meta['tuple'] else frames[0]
+
+def load_fresh(key:Hashable, max_age:float) -> Any:
+    """snapshot of key read from Sheets (by any worker) less than max_age seconds ago, else None"""
+    meta = read_meta(key)
+    if meta is None or time.time() - meta['loaded_at'] > max_age:
+        return None
+    return load(key)
+
+@contextlib.contextmanager
+def fetch_lock(key:Hashable):
+    """host-wide exclusive lock of key (flock), held while a worker fetches it"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(f'{_base(key)}.lock', 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
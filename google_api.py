@@ -1,12 +1,27 @@
+import os
 import json
+import queue
+import hashlib
+import threading
+import functools
+import contextlib
 import pandas as pd
 
 from dataclasses import dataclass
+from typing import Dict, Iterator, List
 
 import httplib2
 import apiclient.discovery
+from googleapiclient.discovery_cache import get_static_doc
 from oauth2client.service_account import ServiceAccountCredentials
 
+from metrics import timed, count
+from gs_scheduler import schedule
+
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+API_VERSIONS = {'sheets': 'v4', 'drive': 'v3'}
+
 
 @dataclass
 class GSPage:
@@ -18,31 +33,279 @@ class GSPage:
     header_row_reserve:int = None
     first_col_letter:str = None # e.g. A
     last_col_letter:str = None # e.g. D
+    append_only:bool = False # rows are only appended, never edited (bills, payments): synced incrementally
 
 
 # google api
+# process-wide pool: credentials and discovery documents are shared by all threads,
+# httplib2.Http is not thread-safe: a service (with its keep-alive connection) is checked out
+# by one thread at a time and returned to the pool, reruns and workers reuse it
+POOL_SIZE = 8 # idle services kept per account and api
+_pool_lock = threading.Lock()
+_credentials = {}   # account key -> ServiceAccountCredentials
+_discovery_docs = {}  # api -> parsed discovery document
+_services = {}  # (account key, api, endpoint) -> queue.Queue of idle services
+
+
+def _account_key(service_account_json:str) -> str:
+    return hashlib.sha1(service_account_json.encode()).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def project_of(service_account_json:str) -> str:
+    """quota bucket of the account: project_id of the service account json"""
+    try:
+        return json.loads(service_account_json, strict=False)['project_id']
+    except (ValueError, KeyError, TypeError):
+        return _account_key(service_account_json)
+
+def _get_credentials(service_account_json:str) -> ServiceAccountCredentials:
+    """parse service account json once, reuse access token until it expires"""
+    key = _account_key(service_account_json)
+    with _pool_lock:
+        credentials = _credentials.get(key)
+        if credentials is None:
+            service_account_file_json = json.loads(service_account_json, strict=False)
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(service_account_file_json, SCOPES)
+            _credentials[key] = credentials
+    # token request outside of the lock: other threads keep working meanwhile
+    if credentials.access_token is None or credentials.access_token_expired:
+        credentials.get_access_token()
+    return credentials
+
+def _get_discovery_doc(api:str) -> dict:
+    """discovery document from the local copy bundled with google-api-python-client"""
+    with _pool_lock:
+        doc = _discovery_docs.get(api)
+        if doc is None:
+            doc = json.loads(get_static_doc(api, API_VERSIONS[api]))
+            _discovery_docs[api] = doc
+    return doc
+
 def get_google_service(service_account_json:str, api:str='sheets'):
-    """return connection to google api
+    """return new connection to google api
     api='sheets'
     api='drive'
+    GS_API_ENDPOINT env var / root secret, e.g. http://localhost:8765/ -> local emulator, see gs_emulator.py
     """
-    service_account_file_json = json.loads(service_account_json, strict=False)
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(service_account_file_json, ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive'])
-    httpAuth = credentials.authorize(httplib2.Http())
-    if api == 'sheets':
-        return apiclient.discovery.build('sheets', 'v4', http = httpAuth)
-    elif api == 'drive':
-        return apiclient.discovery.build('drive', 'v3', credentials=credentials)
-    return None
+    if api not in API_VERSIONS:
+        return None
+    endpoint = os.environ.get('GS_API_ENDPOINT')
+    if endpoint:
+        # local emulator (gs_emulator.py), no auth
+        return apiclient.discovery.build_from_document(_get_discovery_doc(api), http=httplib2.Http(),
+                                                       client_options={'api_endpoint': endpoint})
+    httpAuth = _get_credentials(service_account_json).authorize(httplib2.Http())
+    return apiclient.discovery.build_from_document(_get_discovery_doc(api), http=httpAuth)
+
+@contextlib.contextmanager
+def google_service(service_account_json:str, api:str='sheets'):
+    """connection to google api from the process-wide pool, returned to it at the end of the block"""
+    endpoint = os.environ.get('GS_API_ENDPOINT')
+    key = (_account_key(service_account_json), api, endpoint)
+    with _pool_lock:
+        idle = _services.setdefault(key, queue.Queue(maxsize=POOL_SIZE))
+    try:
+        service = idle.get_nowait()
+    except queue.Empty:
+        service = get_google_service(service_account_json, api)
+    else:
+        if not endpoint:
+            _get_credentials(service_account_json) # renew an expired token before the request
+    try:
+        yield service
+    finally:
+        try:
+            idle.put_nowait(service)
+        except queue.Full:
+            pass
 
     
+def values_to_df(values:list) -> pd.DataFrame:
+    """first row is header"""
+    if not values:
+        return pd.DataFrame()
+    return pd.DataFrame(data=values[1:], columns=values[0])
+
+def _measured(http_request):
+    """http_request counting the size of its response body (fetch_bytes), as received by httplib2"""
+    postproc = http_request.postproc
+    def postproc_measured(resp, content):
+        count('fetch_bytes', len(content))
+        return postproc(resp, content)
+    http_request.postproc = postproc_measured
+    return http_request
+
+def batch_get_values(service, gs_id:str, ranges:List[str], project:str=None) -> List[list]:
+    """values of every range, one batchGet
+    through gs_scheduler: quota of project, identical concurrent requests share one call
+    """
+    def request():
+        # runs in the single-flight leader only: one count per HTTP call
+        count('fetch_requests')
+        return _measured(service.spreadsheets().values().batchGet(spreadsheetId=gs_id, ranges=list(ranges))).execute()
+    with timed('fetch'):
+        result = schedule(project, 'read', request, key=('batchGet', gs_id, tuple(ranges)))
+    return [value_range.get('values', []) for value_range in result['valueRanges']]
+
+def get_gs_tables(service, gs_id:str, gs_page_names:List[str]) -> Dict[str, pd.DataFrame]:
+    """ Get several Google Sheet's pages with one batchGet"""
+    return {page_name: values_to_df(values)
+            for page_name, values in zip(gs_page_names, batch_get_values(service, gs_id, gs_page_names))}
+
 def get_gs_table(service, gs_id:str, gs_page_name:str) -> pd.DataFrame:
     """ Get Google Sheet's page"""
-    result = service.spreadsheets().values().batchGet(spreadsheetId=gs_id, ranges=gs_page_name).execute()
-    columns = result['valueRanges'][0]['values'][0]
-    data = result['valueRanges'][0]['values'][1:]
-    df = pd.DataFrame(data=data, columns=columns)
-    return df
+    return get_gs_tables(service, gs_id, [gs_page_name])[gs_page_name]
+
+
+# incremental sync
+# pages only grow by appended rows: keep rows synced so far and request only the rows after them
+SYNC_TAIL_ROWS = 50 # rows re-read to detect edits of already synced rows
+
+@dataclass
+class GSSnapshot:
+    """rows of GSPage synced so far"""
+    header:list
+    rows:list
+
+    def to_df(self) -> pd.DataFrame:
+        if not self.header:
+            return pd.DataFrame()
+        return pd.DataFrame(data=self.rows, columns=self.header)
+
+_snapshots = {} # (gs_id, page_name) -> GSSnapshot
+_snapshots_lock = threading.Lock()
+
+
+def has_columns(gs:GSPage) -> bool:
+    return bool(gs.first_col_letter and gs.last_col_letter)
+
+def is_syncable(gs:GSPage) -> bool:
+    """append-only page with column letters; editable tables (e.g. lookups) are always read in full"""
+    return gs.append_only and has_columns(gs)
+
+def gs_range(gs:GSPage, first_row:int, last_row:int=None) -> str:
+    """A1 range of gs columns, e.g. 'Page'!A10:C or 'Page'!A10:C20"""
+    page_name = gs.page_name.replace("'", "''")
+    return f"'{page_name}'!{gs.first_col_letter}{first_row}:{gs.last_col_letter}{'' if last_row is None else last_row}"
+
+def rows_checksum(rows:list) -> str:
+    return hashlib.md5(json.dumps(rows, ensure_ascii=False).encode()).hexdigest()
+
+def get_snapshot(gs:GSPage) -> GSSnapshot:
+    with _snapshots_lock:
+        return _snapshots.get((gs.gs_id, gs.page_name))
+
+def set_snapshot(gs:GSPage, snapshot:GSSnapshot) -> None:
+    with _snapshots_lock:
+        if snapshot is None:
+            _snapshots.pop((gs.gs_id, gs.page_name), None)
+        else:
+            _snapshots[(gs.gs_id, gs.page_name)] = snapshot
+
+def _page_ranges(gs:GSPage, snapshot:GSSnapshot, sync:bool) -> List[str]:
+    """ranges to request: whole page, or rows appended after snapshot + its tail window"""
+    if not (sync and is_syncable(gs)):
+        return [gs.page_name]
+    if snapshot is None:
+        return [gs_range(gs, 1)]
+    header_rows = gs.header_row_reserve or 1
+    synced = len(snapshot.rows)
+    ranges = [gs_range(gs, header_rows + synced + 1)]
+    if synced:
+        ranges.append(gs_range(gs, header_rows + max(synced - SYNC_TAIL_ROWS, 0) + 1, header_rows + synced))
+    return ranges
+
+def _sync_snapshot(gs:GSPage, snapshot:GSSnapshot, page_values:List[list]) -> GSSnapshot:
+    """new snapshot, None if synced rows were changed and the page must be reloaded"""
+    header_rows = gs.header_row_reserve or 1
+    if snapshot is None:
+        values = page_values[0]
+        return GSSnapshot(header=values[0] if values else [], rows=values[header_rows:])
+    new_rows = page_values[0]
+    if snapshot.rows:
+        tail = snapshot.rows[max(len(snapshot.rows) - SYNC_TAIL_ROWS, 0):]
+        if rows_checksum(tail) != rows_checksum(page_values[1]):
+            return None
+    if not new_rows:
+        return snapshot
+    return GSSnapshot(header=snapshot.header, rows=snapshot.rows + new_rows)
+
+def get_gs_pages(pages:List[GSPage], sync:bool=False) -> List[pd.DataFrame]:
+    """ Get GSPages, one request per spreadsheet
+    frames are returned in the order of pages
+    sync=True: append_only pages with first_col_letter/last_col_letter are synced incrementally,
+        only rows appended since the previous call are downloaded
+    """
+    plans = {} # (gs_id, page_name) -> (gs, snapshot, ranges)
+    for gs in pages:
+        key = (gs.gs_id, gs.page_name)
+        if key not in plans:
+            snapshot = get_snapshot(gs) if sync else None
+            plans[key] = (gs, snapshot, _page_ranges(gs, snapshot, sync))
+
+    spreadsheets = {}
+    for gs, _, ranges in plans.values():
+        spreadsheets.setdefault((gs.service_account_json, gs.gs_id), []).extend(ranges)
+    values = {}
+    for (service_account_json, gs_id), ranges in spreadsheets.items():
+        with google_service(service_account_json, api='sheets') as service:
+            page_values = batch_get_values(service, gs_id, ranges, project_of(service_account_json))
+        for range, range_values in zip(ranges, page_values):
+            values[(gs_id, range)] = range_values
+
+    tables = {}
+    stale = []
+    for key, (gs, snapshot, ranges) in plans.items():
+        page_values = [values[(gs.gs_id, range)] for range in ranges]
+        if not (sync and is_syncable(gs)):
+            tables[key] = values_to_df(page_values[0])
+            continue
+        snapshot = _sync_snapshot(gs, snapshot, page_values)
+        set_snapshot(gs, snapshot)
+        if snapshot is None:
+            stale.append(gs)
+        else:
+            tables[key] = snapshot.to_df()
+    if stale:
+        # synced rows were edited -> full reload
+        for gs, df in zip(stale, get_gs_pages(stale, sync=True)):
+            tables[(gs.gs_id, gs.page_name)] = df
+    return [tables[(gs.gs_id, gs.page_name)].copy() for gs in pages]
+
+# streaming reads
+# very large pages are read window by window, only the current window is held in memory
+STREAM_CHUNK_ROWS = 10000
+
+def page_row_count(service, gs:GSPage) -> int:
+    """rows of the page grid (filled or not)"""
+    request = service.spreadsheets().get(spreadsheetId=gs.gs_id, ranges=[gs.page_name],
+                fields='sheets.properties.gridProperties.rowCount')
+    result = schedule(project_of(gs.service_account_json), 'read', request.execute)
+    return result['sheets'][0]['properties']['gridProperties']['rowCount']
+
+def iter_gs_page(gs:GSPage, chunk_rows:int=STREAM_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """raw frames (all strings, header of the page) of at most chunk_rows rows each
+    one request per window of rows, gs needs first_col_letter/last_col_letter
+    """
+    if not has_columns(gs):
+        raise ValueError(f'{gs.page_name}: first_col_letter and last_col_letter are required for streaming')
+    header_rows = gs.header_row_reserve or 1
+    project = project_of(gs.service_account_json)
+    # the connection goes back to the pool between windows, not held while the caller reduces
+    with google_service(gs.service_account_json, api='sheets') as service:
+        header_values = batch_get_values(service, gs.gs_id, [gs_range(gs, 1, 1)], project)[0]
+        if not header_values:
+            return
+        row_count = page_row_count(service, gs)
+    header = header_values[0]
+    for first_row in range(header_rows + 1, row_count + 1, chunk_rows):
+        with google_service(gs.service_account_json, api='sheets') as service:
+            rows = batch_get_values(service, gs.gs_id, [gs_range(gs, first_row, first_row + chunk_rows - 1)], project)[0]
+        if not rows:
+            # rows are appended at the end: an empty window is the end of the data,
+            # the empty rest of the grid is not requested (one read token per window)
+            return
+        yield pd.DataFrame(data=rows, columns=header)
 
 def write_to_gs(gs:GSPage, data:list, range:str) -> None:
     """
@@ -53,8 +316,24 @@ def write_to_gs(gs:GSPage, data:list, range:str) -> None:
     """
     service_account_json = gs.service_account_json
     gs_id = gs.gs_id
-    service = get_google_service(service_account_json, api='sheets')
-    result = service.spreadsheets().values().update(
-                spreadsheetId=gs_id, range=range,
-                valueInputOption="USER_ENTERED", body={'values': data}).execute()
-    return None
\ No newline at end of file
+    with google_service(service_account_json, api='sheets') as service:
+        request = service.spreadsheets().values().update(
+                    spreadsheetId=gs_id, range=range,
+                    valueInputOption="USER_ENTERED", body={'values': data})
+        schedule(project_of(service_account_json), 'write', request.execute)
+    return None
+
+def append_to_gs(gs:GSPage, data:list) -> dict:
+    """
+    append rows after the last row of the page (values.append), no computed ranges
+    data:  [[col1, col2,col3],
+            [col1, col2,col3]]
+    returns 'updates' of the response, e.g. {'updatedRange': "'Page'!A120:C121", 'updatedRows': 2, ...}
+    """
+    range = gs_range(gs, 1) if has_columns(gs) else gs.page_name
+    with google_service(gs.service_account_json, api='sheets') as service:
+        request = service.spreadsheets().values().append(
+                    spreadsheetId=gs.gs_id, range=range,
+                    valueInputOption="USER_ENTERED", insertDataOption="INSERT_ROWS", body={'values': data})
+        result = schedule(project_of(gs.service_account_json), 'write', request.execute)
+    return result.get('updates', {})
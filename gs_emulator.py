@@ -0,0 +1,264 @@
+"""Local Google Sheets v4 emulator for offline runs and load tests
+
+Speaks enough of Sheets v4 for google_api: values.batchGet, values.update, values.append
+and spreadsheets.get (grid size of a page, for streaming reads).
+
+    python gs_emulator.py --port 8765 \
+        --page GOOGLESHEET_ID/METERS_PAGE_NAME=fixtures/meters.csv \
+        --page GOOGLESHEET_ID/PAYMENTS_PAGE_NAME=fixtures/payments.parquet \
+        --latency 0.2 --error-rate 0.05
+
+then point the app at it:
+
+    GS_API_ENDPOINT=http://localhost:8765/ streamlit run utilities.py
+
+Fixture files: first row (csv) / columns (parquet) is the header row of the page.
+"""
+import csv
+import json
+import random
+import re
+import threading
+import time
+import argparse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+RANGE_RE = re.compile(r"^([A-Z]*)(\d*)$")
+GRID_ROWS = 1000 # rows of a new sheet grid
+GRID_COLUMNS = 26
+
+
+def col_to_index(letters:str) -> int:
+    """A -> 0, Z -> 25, AA -> 26"""
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+def index_to_col(index:int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+def parse_range(a1:str) -> Tuple[str, int, int, int, int]:
+    """'Page'!A2:C10 -> (page, first_row, last_row, first_col, last_col), 0-based, last None = open"""
+    if '!' in a1:
+        page_name, cells = a1.rsplit('!', 1)
+    else:
+        page_name, cells = a1, ''
+    if page_name.startswith("'") and page_name.endswith("'"):
+        page_name = page_name[1:-1].replace("''", "'")
+    if not cells:
+        return page_name, 0, None, 0, None
+    first, _, last = cells.partition(':')
+    first_col, first_row = RANGE_RE.match(first).groups()
+    last_col, last_row = RANGE_RE.match(last or first).groups()
+    return (page_name,
+            int(first_row) - 1 if first_row else 0,
+            int(last_row) - 1 if last_row else None,
+            col_to_index(first_col) if first_col else 0,
+            col_to_index(last_col) if last_col else None)
+
+def trim_row(row:list) -> list:
+    """sheets api drops trailing empty cells"""
+    end = len(row)
+    while end and row[end - 1] in ('', None):
+        end -= 1
+    return row[:end]
+
+def load_fixture(path:str) -> List[list]:
+    """csv / parquet -> header + rows of strings"""
+    if path.endswith('.parquet'):
+        import pandas as pd
+        df = pd.read_parquet(path).fillna('').astype(str)
+        return [list(df.columns)] + df.values.tolist()
+    with open(path, newline='', encoding='utf-8') as file:
+        return [row for row in csv.reader(file)]
+
+
+class SheetsStore:
+    """pages of emulated spreadsheets: (gs_id, page_name) -> rows"""
+    def __init__(self):
+        self.pages:Dict[Tuple[str, str], List[list]] = {}
+        self.lock = threading.Lock()
+
+    def seed(self, gs_id:str, page_name:str, rows:List[list]) -> None:
+        with self.lock:
+            self.pages[(gs_id, page_name)] = [list(row) for row in rows]
+
+    def get(self, gs_id:str, a1:str) -> dict:
+        page_name, first_row, last_row, first_col, last_col = parse_range(a1)
+        with self.lock:
+            rows = self.pages.get((gs_id, page_name))
+            if rows is None:
+                raise KeyError(page_name)
+            rows = rows[first_row:None if last_row is None else last_row + 1]
+            values = [trim_row(row[first_col:None if last_col is None else last_col + 1]) for row in rows]
+        while values and not values[-1]:
+            values.pop()
+        value_range = {'range': a1, 'majorDimension': 'ROWS'}
+        if values:
+            value_range['values'] = values
+        return value_range
+
+    def grid(self, gs_id:str, a1:str) -> dict:
+        """sheet of spreadsheets.get: title and grid size (rows grow with the data)"""
+        page_name = parse_range(a1)[0]
+        with self.lock:
+            rows = self.pages.get((gs_id, page_name))
+            if rows is None:
+                raise KeyError(page_name)
+            row_count = max(len(rows), GRID_ROWS)
+            column_count = max([len(row) for row in rows] + [GRID_COLUMNS])
+        return {'properties': {'title': page_name, 'gridProperties': {'rowCount': row_count, 'columnCount': column_count}}}
+
+    def update(self, gs_id:str, a1:str, values:List[list]) -> dict:
+        page_name, first_row, _, first_col, _ = parse_range(a1)
+        with self.lock:
+            rows = self.pages.setdefault((gs_id, page_name), [])
+            self._write(rows, first_row, first_col, values)
+        return self._updates(gs_id, page_name, first_row, first_col, values)
+
+    def append(self, gs_id:str, a1:str, values:List[list]) -> dict:
+        page_name, _, _, first_col, _ = parse_range(a1)
+        with self.lock:
+            rows = self.pages.setdefault((gs_id, page_name), [])
+            while rows and not trim_row(rows[-1]):
+                rows.pop()
+            first_row = len(rows)
+            self._write(rows, first_row, first_col, values)
+        return {'spreadsheetId': gs_id, 'updates': self._updates(gs_id, page_name, first_row, first_col, values)}
+
+    @staticmethod
+    def _write(rows:List[list], first_row:int, first_col:int, values:List[list]) -> None:
+        while len(rows) < first_row + len(values):
+            rows.append([])
+        for i, value_row in enumerate(values):
+            row = rows[first_row + i]
+            if len(row) < first_col + len(value_row):
+                row.extend([''] * (first_col + len(value_row) - len(row)))
+            row[first_col:first_col + len(value_row)] = ['' if v is None else str(v) for v in value_row]
+
+    @staticmethod
+    def _updates(gs_id:str, page_name:str, first_row:int, first_col:int, values:List[list]) -> dict:
+        width = max((len(row) for row in values), default=0)
+        last_col = index_to_col(first_col + max(width, 1) - 1)
+        return {'spreadsheetId': gs_id,
+                'updatedRange': f"'{page_name}'!{index_to_col(first_col)}{first_row + 1}:{last_col}{first_row + len(values)}",
+                'updatedRows': len(values),
+                'updatedColumns': width,
+                'updatedCells': sum(len(row) for row in values)}
+
+
+class SheetsHandler(BaseHTTPRequestHandler):
+    """/v4/spreadsheets/{id} (GET), /values:batchGet, /values/{range} (PUT), /values/{range}:append (POST)"""
+    store:SheetsStore = None
+    latency:float = 0.0
+    error_rate:float = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code:int, body:dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, code:int, status:str, message:str) -> None:
+        self._send(code, {'error': {'code': code, 'message': message, 'status': status}})
+
+    def _route(self) -> Tuple[str, str, dict]:
+        url = urlparse(self.path)
+        parts = url.path.split('/')
+        # ['', 'v4', 'spreadsheets', id], [..., 'values:batchGet'] or [..., 'values', range]
+        if len(parts) < 4 or parts[1] != 'v4' or parts[2] != 'spreadsheets':
+            return None, None, None
+        return unquote(parts[3]), unquote('/'.join(parts[4:])), parse_qs(url.query)
+
+    def _throttle(self) -> bool:
+        """injected latency / quota errors, True if request already answered"""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self._error(429, 'RESOURCE_EXHAUSTED', 'Quota exceeded (emulated)')
+            return True
+        return False
+
+    def _body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        gs_id, method, query = self._route()
+        if method not in ('', 'values:batchGet'):
+            return self._error(404, 'NOT_FOUND', self.path)
+        if self._throttle():
+            return
+        if method == '':
+            try:
+                sheets = [self.store.grid(gs_id, a1) for a1 in query.get('ranges', [])]
+            except KeyError as e:
+                return self._error(400, 'INVALID_ARGUMENT', f'Unable to parse range: {e}')
+            return self._send(200, {'spreadsheetId': gs_id, 'sheets': sheets})
+        try:
+            value_ranges = [self.store.get(gs_id, a1) for a1 in query.get('ranges', [])]
+        except KeyError as e:
+            return self._error(400, 'INVALID_ARGUMENT', f'Unable to parse range: {e}')
+        self._send(200, {'spreadsheetId': gs_id, 'valueRanges': value_ranges})
+
+    def do_PUT(self):
+        gs_id, method, _ = self._route()
+        if not method or not method.startswith('values/'):
+            return self._error(404, 'NOT_FOUND', self.path)
+        if self._throttle():
+            return
+        self._send(200, self.store.update(gs_id, method[len('values/'):], self._body().get('values', [])))
+
+    def do_POST(self):
+        gs_id, method, _ = self._route()
+        if not method or not method.startswith('values/') or not method.endswith(':append'):
+            return self._error(404, 'NOT_FOUND', self.path)
+        if self._throttle():
+            return
+        self._send(200, self.store.append(gs_id, method[len('values/'):-len(':append')], self._body().get('values', [])))
+
+
+def serve(store:SheetsStore, host:str='localhost', port:int=8765, latency:float=0.0, error_rate:float=0.0) -> ThreadingHTTPServer:
+    """start emulator in a background thread, server.shutdown() to stop"""
+    handler = type('Handler', (SheetsHandler,), {'store': store, 'latency': latency, 'error_rate': error_rate})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--page', action='append', default=[], help='GS_ID/PAGE_NAME=fixture.csv|.parquet')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429')
+    args = parser.parse_args()
+
+    store = SheetsStore()
+    for page in args.page:
+        target, path = page.split('=', 1)
+        gs_id, page_name = target.split('/', 1)
+        store.seed(gs_id, page_name, load_fixture(path))
+    server = serve(store, args.host, args.port, args.latency, args.error_rate)
+    print(f'Sheets emulator on http://{args.host}:{args.port}/')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,159 @@
+"""Quota-aware scheduler in front of google_api
+
+Every request takes a token of its project's bucket (reads and writes are separate quotas),
+interactive requests go before background ones (prefetch, cache refresh, writer),
+identical concurrent requests share one call (single-flight),
+quota (429) and server (5xx) errors of reads are retried with jittered exponential backoff,
+writes only on 429: values.append is not idempotent, after a 5xx the rows may be written already.
+Spikes turn into short waits instead of failed pages.
+"""
+import os
+import time
+import random
+import threading
+import contextlib
+
+from typing import Any, Callable, Dict, Hashable
+
+from googleapiclient.errors import HttpError
+
+from metrics import count, timed
+
+
+READS_PER_MINUTE = float(os.environ.get('GS_READS_PER_MINUTE', 60)) # Sheets: per minute per user per project
+WRITES_PER_MINUTE = float(os.environ.get('GS_WRITES_PER_MINUTE', 60))
+BURST = 10 # tokens a bucket holds
+
+RETRY_STATUSES = {'read': (429, 500, 502, 503, 504), 'write': (429,)} # per kind
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1.0 # seconds
+BACKOFF_CAP = 32.0
+
+
+def is_retryable(error:Exception, kind:str='read') -> bool:
+    return isinstance(error, HttpError) and error.resp.status in RETRY_STATUSES[kind]
+
+def backoff(attempt:int) -> float:
+    """full jitter: uniform(0, min(cap, base * 2**attempt))"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+# priority of the current thread
+_local = threading.local()
+
+@contextlib.contextmanager
+def background():
+    """requests of this block wait while interactive ones are waiting"""
+    previous = getattr(_local, 'background', False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+def is_background() -> bool:
+    return getattr(_local, 'background', False)
+
+def in_background(func:Callable, *args, **kwargs) -> Any:
+    """func(*args, **kwargs) with background priority, e.g. for executor.submit"""
+    with background():
+        return func(*args, **kwargs)
+
+
+class TokenBucket:
+    """rate tokens per minute, at most capacity"""
+    def __init__(self, per_minute:float, capacity:float=BURST):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.interactive_waiting = 0
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """seconds until the next token"""
+        return max(1.0 - self.tokens, 0.0) / self.rate if self.rate else 1.0
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Scheduler:
+    def __init__(self, reads_per_minute:float=READS_PER_MINUTE, writes_per_minute:float=WRITES_PER_MINUTE):
+        self.rates = {'read': reads_per_minute, 'write': writes_per_minute}
+        self.buckets:Dict[tuple, TokenBucket] = {} # (project, kind) -> bucket
+        self.inflight:Dict[Hashable, _Call] = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, project:str, kind:str, background:bool=False) -> None:
+        """block until a token of (project, kind) is free; background waits for interactive waiters"""
+        with self.condition:
+            bucket = self.buckets.get((project, kind))
+            if bucket is None:
+                bucket = self.buckets[(project, kind)] = TokenBucket(self.rates[kind])
+            if not background:
+                bucket.interactive_waiting += 1
+            try:
+                while True:
+                    bucket.refill()
+                    if bucket.tokens >= 1 and (not background or bucket.interactive_waiting == 0):
+                        bucket.tokens -= 1
+                        return
+                    self.condition.wait(bucket.wait_time() if bucket.tokens < 1 else 0.05)
+            finally:
+                if not background:
+                    bucket.interactive_waiting -= 1
+                self.condition.notify_all()
+
+    def call(self, project:str, kind:str, func:Callable[[], Any], key:Hashable=None) -> Any:
+        """func() under the limiter, retried on RETRY_STATUSES[kind]; concurrent calls with the same key share one func()"""
+        if key is None:
+            return self._run(project, kind, func)
+        with self.condition:
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = _Call()
+        if not leader:
+            count('gs_coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(project, kind, func)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.condition:
+                self.inflight.pop(key, None)
+            call.done.set()
+
+    def _run(self, project:str, kind:str, func:Callable[[], Any]) -> Any:
+        for attempt in range(MAX_ATTEMPTS):
+            with timed('quota_wait'):
+                self.acquire(project, kind, is_background())
+            try:
+                return func()
+            except Exception as e:
+                if not is_retryable(e, kind) or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                count(f'gs_retries_{e.resp.status}')
+                time.sleep(backoff(attempt))
+
+
+SCHEDULER = Scheduler()
+
+
+def schedule(project:str, kind:str, func:Callable[[], Any], key:Hashable=None) -> Any:
+    return SCHEDULER.call(project, kind, func, key)
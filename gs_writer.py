@@ -0,0 +1,93 @@
+"""Background writer for Google Sheets
+
+Form submits put rows into a queue and return at once.
+One thread appends pending rows per GSPage with a single values.append
+(quota and retries of 429: gs_scheduler; a 5xx is not retried, the rows may be written already,
+it is reported on the WriteJobs as error).
+Rows are appended, so concurrent sessions never overwrite each other.
+Write listeners (add_write_listener) see every successful append before its jobs are done,
+e.g. to patch cached frames.
+"""
+import logging
+import threading
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from google_api import GSPage, append_to_gs
+from gs_scheduler import background
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WriteJob:
+    """rows of one submit, done is set when they are written or failed"""
+    rows:list
+    done:threading.Event = field(default_factory=threading.Event)
+    error:Exception = None
+    updated_range:str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.done.is_set() and self.error is None
+
+
+class GSWriter:
+    """single background thread, pending jobs coalesced per GSPage"""
+    def __init__(self):
+        self.pending:Dict[tuple, List] = {} # (gs_id, page_name) -> [gs, [jobs]]
+        self.condition = threading.Condition()
+        self.thread = None
+        self.listeners:List[Callable[[GSPage, list], None]] = []
+
+    def submit(self, gs:GSPage, rows:list) -> WriteJob:
+        job = WriteJob(rows=rows)
+        with self.condition:
+            self.pending.setdefault((gs.gs_id, gs.page_name), [gs, []])[1].append(job)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='gs-writer', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return job
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                _, (gs, jobs) = self.pending.popitem()
+            self._write(gs, jobs)
+
+    def _write(self, gs:GSPage, jobs:List[WriteJob]) -> None:
+        rows = [row for job in jobs for row in job.rows]
+        error = None
+        try:
+            with background(): # queued appends wait while pages read
+                updates = append_to_gs(gs, rows)
+        except Exception as e:
+            error = e
+        if error is None:
+            for listener in self.listeners:
+                try:
+                    listener(gs, rows)
+                except Exception:
+                    logger.exception(f'write listener {listener.__name__} failed')
+        for job in jobs:
+            job.error = error
+            job.updated_range = None if error else updates.get('updatedRange')
+            job.done.set()
+
+
+WRITER = GSWriter()
+
+
+def write_async(gs:GSPage, rows:list) -> WriteJob:
+    """queue rows for appending to gs, returns at once"""
+    return WRITER.submit(gs, rows)
+
+def add_write_listener(listener:Callable[[GSPage, list], None]) -> Callable[[GSPage, list], None]:
+    """call listener(gs, rows) in the writer thread after rows are appended to gs"""
+    WRITER.listeners.append(listener)
+    return listener
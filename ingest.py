@@ -0,0 +1,135 @@
+"""Typed ingest of Google Sheet pages
+
+Every page has a declared schema: sheet column -> frame column, type and format.
+Raw string values are parsed column-wise with vectorized pandas/numpy ops.
+"""
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Union
+
+import numpy as np
+import pandas as pd
+
+from google_api import values_to_df
+
+
+@dataclass
+class Field:
+    """sheet column -> typed frame column"""
+    column:Union[str, int] # header in sheet or position of the column
+    name:str # column in frame
+    type:str = 'str' # str / number / date
+    format:str = None # date format, e.g. %d.%m.%Y
+
+
+DATE_FORMAT = '%d.%m.%Y'
+NUMBER_JUNK = r'[\s,]' # thousands separators: '1 000.50', '1,000.50'
+
+METERS_SCHEMA = [
+    Field('Дата', 'date', 'date', DATE_FORMAT),
+    Field('счетчик', 'meter'),
+    Field('место', 'place'),
+    Field('показания', 'value', 'number'),
+    Field('потребление', 'consumption', 'number'),
+]
+
+PAYMENTS_SCHEMA = [
+    Field('Дата', 'date', 'date', DATE_FORMAT),
+    Field(1, 'service'),
+    Field(2, 'supplier'),
+    Field('сумма', 'summ', 'number'),
+    Field('комиссия', 'commision', 'number'),
+]
+
+PHONE_BILLS_SCHEMA = [
+    Field('Дата', 'date', 'date', DATE_FORMAT),
+    Field('Номер', 'number'),
+    Field('Сумма', 'summ', 'number'),
+]
+
+PHONE_MATCH_SCHEMA = [
+    Field('Номер', 'number'),
+    Field(1, 'owner'),
+    Field(2, 'group'),
+    Field(3, 'is_active', 'number'),
+]
+
+
+def month_end(dates:pd.Series) -> pd.Series:
+    """vectorized utilities.date_eom: last day of the month, NaT stays NaT"""
+    months = dates.values.astype('datetime64[M]')
+    eom = (months + np.timedelta64(1, 'M')).astype('datetime64[D]') - np.timedelta64(1, 'D')
+    return pd.Series(eom.astype('datetime64[ns]'), index=dates.index, name=dates.name)
+
+def parse_numbers(ser:pd.Series) -> pd.Series:
+    """'1 000.50' / '1,000.50' -> 1000.5, '' -> NaN; space and comma are thousands separators, the decimal point is '.'"""
+    if ser.dtype != object:
+        return pd.to_numeric(ser, errors='coerce')
+    return pd.to_numeric(ser.str.replace(NUMBER_JUNK, '', regex=True), errors='coerce')
+
+def parse_dates(ser:pd.Series, format:str=DATE_FORMAT) -> pd.Series:
+    return pd.to_datetime(ser, format=format, errors='coerce', cache=True)
+
+def typed_frame(df:pd.DataFrame, schema:List[Field]) -> pd.DataFrame:
+    """raw page (all strings) -> frame with schema columns only, typed"""
+    columns = {}
+    for field in schema:
+        ser = df.iloc[:, field.column] if isinstance(field.column, int) else df[field.column]
+        if field.type == 'number':
+            ser = parse_numbers(ser)
+        elif field.type == 'date':
+            ser = parse_dates(ser, field.format or DATE_FORMAT)
+        columns[field.name] = ser.values
+    return pd.DataFrame(columns, index=df.index)
+
+def parse_values(values:list, schema:List[Field]) -> pd.DataFrame:
+    """values of batchGet (first row is header) -> typed frame"""
+    return typed_frame(values_to_df(values), schema)
+
+def typed_chunks(chunks:Iterable[pd.DataFrame], schema:List[Field]) -> Iterator[pd.DataFrame]:
+    """raw chunks (google_api.iter_gs_page) -> typed chunks"""
+    for chunk in chunks:
+        yield typed_frame(chunk, schema)
+
+def reduce_monthly(chunks:Iterable[pd.DataFrame], keys:List[str], sums:List[str]=(), maxs:List[str]=()) -> pd.DataFrame:
+    """typed chunks with date -> one row per keys + date_eom with sums / maxs
+    partial aggregates are combined as chunks arrive: memory is bounded by chunk size + number of groups
+    """
+    aggs = {**{column: 'sum' for column in sums}, **{column: 'max' for column in maxs}}
+    by = list(keys) + ['date_eom']
+    total = None
+    for chunk in chunks:
+        chunk['date_eom'] = month_end(chunk['date'])
+        part = chunk.groupby(by)[list(aggs)].agg(aggs)
+        total = part if total is None else pd.concat([total, part]).groupby(level=by).agg(aggs)
+    if total is None:
+        return pd.DataFrame(columns=by + list(aggs)).astype({'date_eom': 'datetime64[ns]'})
+    return total.reset_index()
+
+
+# compact layout
+# amounts stay float64: pages sum them with groupby and float32 sums lose kopecks
+def compact_frame(df:pd.DataFrame, categories:List[str]=()) -> pd.DataFrame:
+    """repeated strings -> category, year -> int16, month_num -> int8"""
+    df = df.copy()
+    for column in categories:
+        df[column] = df[column].astype('category')
+    if 'year' in df and df['year'].notna().all():
+        df['year'] = df['year'].astype('int16')
+    if 'month_num' in df and df['month_num'].notna().all():
+        df['month_num'] = df['month_num'].astype('int8')
+    return df
+
+def plain_frame(df:pd.DataFrame) -> pd.DataFrame:
+    """category columns back to object, e.g. before handing a frame to plotly express"""
+    categories = df.select_dtypes('category').columns
+    if not len(categories):
+        return df
+    return df.astype({column: object for column in categories})
+
+def memory_report(df:pd.DataFrame, df_compact:pd.DataFrame) -> pd.DataFrame:
+    """bytes per column of plain and compact layouts"""
+    report = pd.DataFrame({'plain': df.memory_usage(index=False, deep=True),
+                           'compact': df_compact.memory_usage(index=False, deep=True)})
+    report.loc['total'] = report.sum()
+    report['ratio'] = report['plain'] / report['compact']
+    return report
@@ -0,0 +1,447 @@
+"""Sheet-backed loaders and their registry
+
+Every loader declares the GSPages it reads (from st.secrets) and a transform of the raw pages.
+Results are kept per process for a ttl (stale-while-revalidate, see cache.py) and on disk
+(frame_store.py), shared by the workers of the host: one worker fetches, the others read its snapshot;
+after a restart the disk snapshot is served while Sheets is read in background;
+prefetch() loads all of them in parallel on a thread pool, one request per spreadsheet,
+so pages find their data ready.
+"""
+import logging
+import threading
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, astuple
+from typing import Any, Callable, Dict, Iterator, List
+
+import pandas as pd
+import streamlit as st
+
+import frame_store
+from cache import SWRCache
+from features import period_features
+from google_api import get_gs_pages, iter_gs_page
+from google_api import GSPage
+from gs_scheduler import background, in_background
+from rollups import MetersCube, MonthIndex
+from gs_writer import add_write_listener
+from ingest import typed_frame, parse_values, month_end, compact_frame, plain_frame
+from ingest import typed_chunks, reduce_monthly
+from ingest import METERS_SCHEMA, PAYMENTS_SCHEMA, PHONE_BILLS_SCHEMA, PHONE_MATCH_SCHEMA
+from metrics import timed
+
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = 4
+DEFAULT_TTL = 300 # seconds
+
+METER_GROUPS = {
+    'water': ['ХВС', 'ГВС'],
+    'electricity': ['ЭЛ.ЭНЕРГИЯ'],
+    'gas': ['ГАЗ'],
+}
+
+
+# sources
+def meters_gs() -> GSPage:
+    return GSPage(
+            service_account_json=st.secrets['SERVICE_ACCOUNT_JSON'],
+            gs_id=st.secrets['GOOGLESHEET_ID'],
+            page_id=st.secrets['METERS_PAGE_ID'],
+            page_name=st.secrets['METERS_PAGE_NAME']
+            )
+
+def payments_gs() -> GSPage:
+    return GSPage(
+            service_account_json=st.secrets['SERVICE_ACCOUNT_JSON'],
+            gs_id=st.secrets['GOOGLESHEET_ID'],
+            page_id=st.secrets['PAYMENTS_PAGE_ID'],
+            page_name=st.secrets['PAYMENTS_PAGE_NAME'],
+            header_row_reserve=1,
+            first_col_letter='A',
+            last_col_letter='E',
+            append_only=True
+            )
+
+def phone_bills_gs() -> GSPage:
+    return GSPage(
+            service_account_json=st.secrets['SERVICE_ACCOUNT_JSON'],
+            gs_id=st.secrets['PHONE_GOOGLESHEET_ID'],
+            page_id=st.secrets['PHONE_BILLS_PAGE_ID'],
+            page_name=st.secrets['PHONE_BILLS_PAGE_NAME'],
+            header_row_reserve=1,
+            first_col_letter='A',
+            last_col_letter='C',
+            append_only=True
+            )
+
+def match_gs() -> GSPage:
+    return GSPage(
+            service_account_json=st.secrets['SERVICE_ACCOUNT_JSON'],
+            gs_id=st.secrets['PHONE_GOOGLESHEET_ID'],
+            page_id=st.secrets['PHONE_MATCH_PAGE_ID'],
+            page_name=st.secrets['PHONE_MATCH_NAME'],
+            header_row_reserve=1,
+            first_col_letter='A',
+            last_col_letter='D'
+            )
+
+
+# transforms: raw pages -> frames
+def meters_from_gs(df_meters:pd.DataFrame) -> pd.DataFrame:
+    df_meters = typed_frame(df_meters, METERS_SCHEMA)
+    df_meters['date_eom'] = month_end(df_meters['date'])
+    
+    df_meters_by_month = df_meters.groupby(['meter', 'date_eom']).agg({'value':'max','consumption':'sum' }).reset_index().sort_values('date_eom', kind='stable')
+    df_meters_by_month.columns = ['meter', 'date_eom', 'value', 'consumption']
+    df_meters_by_month['prev_consumption'] = period_features(df_meters_by_month, ['meter'], ['consumption'])['prev_consumption']
+    df_meters_by_month['year'] = df_meters_by_month['date_eom'].dt.year
+    df_meters_by_month['month_num'] = df_meters_by_month['date_eom'].dt.month
+    return compact_frame(df_meters_by_month.reset_index(drop=True), categories=['meter'])
+
+def payments_from_gs(df_payments:pd.DataFrame) -> pd.DataFrame:
+    df_payments = typed_frame(df_payments, PAYMENTS_SCHEMA)
+    df_payments['date_eom'] = month_end(df_payments['date'])
+    df_payments['summ_w_comm'] = df_payments['summ'].fillna(0) + df_payments['commision'].fillna(0)
+
+    df_payments.sort_values('date_eom', kind='stable', inplace=True, ignore_index=True)
+    prev = period_features(df_payments, ['service', 'supplier'], ['summ', 'commision', 'summ_w_comm'])
+    df_payments['prev_summ'] = prev['prev_summ']
+    df_payments['prev_comm'] = prev['prev_commision']
+    df_payments['prev_summ_w_comm'] = prev['prev_summ_w_comm']
+    
+    df_payments['year'] = df_payments['date_eom'].dt.year
+    df_payments['month_num'] = df_payments['date_eom'].dt.month
+    supplier = df_payments['supplier'].astype(str)
+    service = df_payments['service'].astype(str)
+    df_payments['supplier_service'] = supplier + '_' + service
+    df_payments['supplier_service_formated'] = '__:blue[' + supplier + ']__  \n(_' + service + '_)'
+    return compact_frame(df_payments,
+                         categories=['service', 'supplier', 'supplier_service', 'supplier_service_formated'])
+
+def _phone_bills(df_bills:pd.DataFrame, df_matches:pd.DataFrame) -> pd.DataFrame:
+    """typed bills + date_eom, owner and group of the number"""
+    df_bills['date_eom'] = month_end(df_bills['date'])
+    return _with_matches(df_bills, df_matches)
+
+def _with_matches(df_bills:pd.DataFrame, df_matches:pd.DataFrame) -> pd.DataFrame:
+    return df_bills.set_index('number').join(df_matches.set_index('number')).reset_index()
+
+def _phones_by_month(df:pd.DataFrame) -> pd.DataFrame:
+    df = df.groupby(['number','date_eom', 'owner', 'group'])['summ'].sum().reset_index().sort_values('date_eom', kind='stable', ignore_index=True)
+    df['prev_summ'] = period_features(df, ['number'], ['summ'])['prev_summ']
+
+    df['year'] = df['date_eom'].dt.year
+    df['month_num'] = df['date_eom'].dt.month
+    return df
+
+def phones_from_gs(df_bills:pd.DataFrame, df_matches:pd.DataFrame) -> pd.DataFrame:
+    df_bills = typed_frame(df_bills, PHONE_BILLS_SCHEMA)
+    df_matches = typed_frame(df_matches, PHONE_MATCH_SCHEMA)
+    df = _phones_by_month(_phone_bills(df_bills, df_matches))
+
+    df_matches['is_active'] = df_matches['is_active'].fillna(0).astype(int)
+    df = compact_frame(df, categories=['number', 'owner', 'group'])
+    return df, df_matches
+
+def phones_from_chunks(bill_chunks:Iterator[pd.DataFrame], match_chunks:Iterator[pd.DataFrame]) -> pd.DataFrame:
+    """phones_from_gs for pages read in windows: bills are reduced to monthly sums chunk by chunk"""
+    matches = list(typed_chunks(match_chunks, PHONE_MATCH_SCHEMA))
+    df_matches = pd.concat(matches, ignore_index=True) if matches else pd.DataFrame(columns=[f.name for f in PHONE_MATCH_SCHEMA])
+    df_monthly = reduce_monthly(typed_chunks(bill_chunks, PHONE_BILLS_SCHEMA), ['number'], sums=['summ'])
+    df = _phones_by_month(_with_matches(df_monthly, df_matches))
+
+    df_matches['is_active'] = df_matches['is_active'].fillna(0).astype(int)
+    df = compact_frame(df, categories=['number', 'owner', 'group'])
+    return df, df_matches
+
+def phones_append(phones:tuple, rows:list) -> tuple:
+    """result of phones_from_gs with bill rows (as appended to the sheet) added
+    only the months of the written numbers are recomputed
+    """
+    df, df_matches = phones
+    header = [field.column for field in PHONE_BILLS_SCHEMA]
+    df_bills = parse_values([header] + [[str(value) for value in row] for row in rows], PHONE_BILLS_SCHEMA)
+    df_new = _phone_bills(df_bills, df_matches[['number', 'owner', 'group']])
+
+    written = df['number'].isin(set(df_new['number'])).values
+    df_old = plain_frame(df[written])[['number', 'date_eom', 'owner', 'group', 'summ']]
+    df_patched = _phones_by_month(pd.concat([df_old, df_new[df_old.columns]], ignore_index=True))
+    df = pd.concat([plain_frame(df[~written]), df_patched], ignore_index=True).sort_values('date_eom', kind='stable', ignore_index=True)
+    df = compact_frame(df, categories=['number', 'owner', 'group'])
+    return df, df_matches
+
+
+# registry
+@dataclass
+class Loader:
+    """pages a loader reads and how they become its result"""
+    name:str
+    sources:Callable[[], List[GSPage]] # default pages, from st.secrets
+    transform:Callable[..., Any] # (*raw frames) -> result
+    ttl:float = None # seconds a result is fresh, None: loader_ttl()
+    reduce:Callable[..., Any] = None # (*raw chunk iterators) -> result, if the loader is in STREAM_LOADERS
+
+
+LOADERS:Dict[str, Loader] = {}
+
+def register(loader:Loader) -> Loader:
+    LOADERS[loader.name] = loader
+    return loader
+
+register(Loader('meters', lambda: [meters_gs()], meters_from_gs))
+register(Loader('payments', lambda: [payments_gs()], payments_from_gs))
+register(Loader('phones', lambda: [phone_bills_gs(), match_gs()], phones_from_gs, reduce=phones_from_chunks))
+
+
+CACHE = SWRCache(refresh_context=background) # (name, pages key) -> result
+_lock = threading.Lock()
+_prefetch_started = False
+_seeded = set() # keys whose disk snapshot was looked up
+
+
+def loader_ttl(loader:Loader) -> float:
+    """loader.ttl, LOADER_TTL from st.secrets or DEFAULT_TTL"""
+    if loader.ttl is not None:
+        return loader.ttl
+    try:
+        return float(st.secrets.get('LOADER_TTL', DEFAULT_TTL))
+    except Exception:
+        return DEFAULT_TTL
+
+def streamed(loader:Loader) -> bool:
+    """read in windows (iter_gs_page) and reduced chunk by chunk: for pages too large for one response
+    loaders listed in STREAM_LOADERS of st.secrets; no incremental sync
+    """
+    if loader.reduce is None:
+        return False
+    try:
+        return loader.name in st.secrets.get('STREAM_LOADERS', [])
+    except Exception:
+        return False
+
+def _key(name:str, pages:List[GSPage]) -> tuple:
+    return (name, tuple(astuple(gs) for gs in pages))
+
+def load(name:str, pages:List[GSPage]=None) -> Any:
+    """result of loader name for pages (default: its sources)
+    fetched once, served from CACHE; after the ttl the stale result is served while it is refreshed in background
+    """
+    loader = LOADERS[name]
+    pages = loader.sources() if pages is None else pages
+    key = _key(name, pages)
+    seed(key)
+    ttl = loader_ttl(loader)
+    return CACHE.get(key, lambda: _fetch(loader, pages, key, ttl), ttl)
+
+def _fetch(loader:Loader, pages:List[GSPage], key:tuple, ttl:float) -> Any:
+    """fetch once per ttl per host: a snapshot saved by another worker meanwhile is read instead"""
+    with frame_store.fetch_lock(key):
+        shared = read_fresh(key, ttl)
+        if shared is not None:
+            return shared
+        if streamed(loader):
+            result = _reduce(loader, pages)
+        else:
+            result = _transform(loader, get_gs_pages(pages, sync=True))
+        # a result made obsolete by a write (CACHE.patch) is not stored, it must not replace the patched snapshot
+        if CACHE.storable(key):
+            save_snapshot(key, result)
+        return result
+
+def read_fresh(key:tuple, ttl:float) -> Any:
+    """snapshot of key read from Sheets less than ttl ago (by any worker), else None"""
+    try:
+        with timed('snapshot_read'):
+            return frame_store.load_fresh(key, ttl)
+    except Exception:
+        logger.exception(f'snapshot of {key[0]} is unreadable')
+        return None
+
+def seed(key:tuple) -> bool:
+    """put the disk snapshot of key into CACHE (as stale), once per process; True if seeded"""
+    with _lock:
+        if key in _seeded:
+            return False
+        _seeded.add(key)
+    if CACHE.peek(key) is not None:
+        return False
+    try:
+        with timed('snapshot_read'):
+            value = frame_store.load(key)
+    except Exception:
+        logger.exception(f'snapshot of {key[0]} is unreadable')
+        return False
+    return value is not None and CACHE.seed(key, value)
+
+def save_snapshot(key:tuple, result:Any, loaded_at:float=None) -> None:
+    """frame_store.save, call under frame_store.fetch_lock(key)"""
+    try:
+        with timed('snapshot_write'):
+            frame_store.save(key, result, loaded_at)
+    except Exception:
+        logger.exception(f'snapshot of {key[0]} is not saved')
+
+def _transform(loader:Loader, raw:List[pd.DataFrame]) -> Any:
+    with timed(f'transform:{loader.name}'):
+        return loader.transform(*raw)
+
+def _reduce(loader:Loader, pages:List[GSPage]) -> Any:
+    # fetch and transform interleave, timed together
+    with timed(f'reduce:{loader.name}'):
+        return loader.reduce(*[iter_gs_page(gs) for gs in pages])
+
+@add_write_listener
+def _phone_bills_written(gs:GSPage, rows:list) -> None:
+    """write-through: appended bills are patched into cached phones of that page, no reload"""
+    match = lambda key: key[0] == 'phones' and key[1][0] == astuple(gs)
+    keys = CACHE.keys(match)
+    patched = CACHE.patch(match, lambda phones: phones_append(phones, rows))
+    for key in keys:
+        # under the lock: after a fetch of key running now has saved (or skipped) its result
+        with frame_store.fetch_lock(key):
+            entry = CACHE.peek(key) if key in patched else None
+            if entry is not None:
+                # other workers read the patched snapshot instead of one that misses the rows;
+                # it keeps the loaded_at of the cached result: not fresher than the last read of Sheets, refreshed on ttl
+                save_snapshot(key, entry.value, entry.loaded_at)
+            else:
+                # being loaded, nothing to patch: the snapshot misses the rows, the next load reads Sheets
+                frame_store.expire(key)
+
+def prefetch(names:List[str]=None, max_workers:int=PREFETCH_WORKERS) -> Dict[str, Any]:
+    """load all loaders (or names) in parallel, one request per spreadsheet
+    worst-case latency is the slowest spreadsheet, not the sum
+    like _fetch, loaders are fetched under their fetch_lock: a snapshot fetched by another worker meanwhile is read instead
+    """
+    names = list(LOADERS) if names is None else names
+    plans = {} # name -> (key, pages)
+    events = {}
+    singles = [] # through load(): streamed loaders and snapshots served from disk (refreshed by load in background)
+    for name in names:
+        try:
+            pages = LOADERS[name].sources()
+        except Exception: # e.g. its secrets are missing: the other loaders are still warmed
+            logger.exception(f'prefetch of {name} failed')
+            continue
+        key = _key(name, pages)
+        if seed(key) or streamed(LOADERS[name]):
+            singles.append(name)
+            continue
+        event = CACHE.claim(key)
+        if event is None: # cached or being loaded
+            continue
+        plans[name] = (key, pages)
+        events[name] = event
+
+    results = {}
+    locks = {} # name -> held fetch_lock, released when the loader is done
+    try:
+        # one order on all workers: no deadlocks between their prefetches
+        for name, (key, _) in sorted(plans.items(), key=lambda item: repr(item[1][0])):
+            locks[name] = contextlib.ExitStack()
+            locks[name].enter_context(frame_store.fetch_lock(key))
+            shared = read_fresh(key, loader_ttl(LOADERS[name]))
+            if shared is not None:
+                del plans[name]
+                CACHE.release(key, events.pop(name), shared, True)
+                results[name] = shared
+                locks.pop(name).close()
+        _prefetch_pages(plans, events, locks, singles, results, max_workers)
+    finally:
+        for name, (key, _) in plans.items():
+            CACHE.release(key, events.pop(name))
+        for lock in locks.values():
+            lock.close()
+    return results
+
+def _prefetch_pages(plans:dict, events:dict, locks:dict, singles:List[str], results:dict, max_workers:int) -> None:
+    """fetch the spreadsheets of plans (name -> (key, pages)) in parallel and load singles
+    done loaders leave plans, their result is saved under the held lock and the lock is released
+    """
+    spreadsheets = {}
+    for name, (_, pages) in plans.items():
+        for gs in pages:
+            spreadsheets.setdefault((gs.service_account_json, gs.gs_id), {})[(gs.gs_id, gs.page_name)] = gs
+    raw = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch') as executor:
+        futures = {executor.submit(in_background, get_gs_pages, list(pages.values()), True): list(pages)
+                   for pages in spreadsheets.values()}
+        single_futures = {executor.submit(in_background, load, name): name for name in singles}
+        for future in as_completed(futures):
+            try:
+                raw.update(zip(futures[future], future.result()))
+            except Exception:
+                logger.exception('prefetch failed')
+            # loaders whose pages are all here
+            for name, (key, pages) in list(plans.items()):
+                if all((gs.gs_id, gs.page_name) in raw for gs in pages):
+                    try:
+                        results[name] = _transform(LOADERS[name], [raw[(gs.gs_id, gs.page_name)].copy() for gs in pages])
+                    except Exception:
+                        logger.exception(f'prefetch of {name} failed')
+                    del plans[name]
+                    if CACHE.release(key, events.pop(name), results.get(name), name in results):
+                        save_snapshot(key, results[name])
+                    locks.pop(name).close()
+        for future in as_completed(single_futures):
+            try:
+                results[single_futures[future]] = future.result()
+            except Exception:
+                logger.exception(f'prefetch of {single_futures[future]} failed')
+
+def start_prefetch() -> None:
+    """prefetch() in a background thread, once per process; call from every page"""
+    global _prefetch_started
+    with _lock:
+        if _prefetch_started:
+            return
+        _prefetch_started = True
+    threading.Thread(target=prefetch, name='prefetch', daemon=True).start()
+
+def warm_up() -> Dict[str, Any]:
+    """warm-up hook: prefetch and wait"""
+    return prefetch()
+
+
+# loaders used by pages
+# frames are sorted by date_eom
+_derived = {} # kind -> (loader result, value built from it), for the latest result
+
+def derived(kind:str, result:Any, build:Callable[[Any], Any]) -> Any:
+    """build(result) once per loader result"""
+    with _lock:
+        cached = _derived.get(kind)
+    if cached is not None and cached[0] is result:
+        return cached[1]
+    value = build(result)
+    with _lock:
+        _derived[kind] = (result, value)
+    return value
+
+def get_meters(meters_gs:GSPage) -> pd.DataFrame:
+    return load('meters', [meters_gs])
+
+def _meters_cube(df_meters_by_month:pd.DataFrame) -> MetersCube:
+    with timed('aggregate'):
+        return MetersCube(df_meters_by_month, METER_GROUPS)
+
+def get_meters_cube(meters_gs:GSPage) -> MetersCube:
+    """rollups of get_meters for every group of METER_GROUPS, built once per result of get_meters"""
+    return derived('meters_cube', get_meters(meters_gs), _meters_cube)
+
+def get_payments(payments_gs:GSPage) -> pd.DataFrame:
+    return load('payments', [payments_gs])
+
+def get_payments_index(payments_gs:GSPage) -> MonthIndex:
+    """get_payments by month, entity: supplier_service"""
+    return derived('payments_index', get_payments(payments_gs), lambda df: MonthIndex(df, 'supplier_service'))
+
+def get_phones(phone_bills_gs:GSPage, match_gs:GSPage) -> pd.DataFrame:
+    return load('phones', [phone_bills_gs, match_gs])
+
+def get_phones_index(phone_bills_gs:GSPage, match_gs:GSPage) -> MonthIndex:
+    """frame of get_phones by month, entity: number"""
+    return derived('phones_index', get_phones(phone_bills_gs, match_gs)[0], lambda df: MonthIndex(df, 'number'))
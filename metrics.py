@@ -0,0 +1,112 @@
+"""Per-stage timings and counters
+
+Stages: auth, fetch, transform:<loader>, aggregate, figure, render.
+Process totals are kept in METRICS; the stages of the current rerun are kept
+per script thread (start_rerun / rerun_stages), background threads only count into totals.
+Export: Prometheus text file (totals) and a JSON line per rerun, to METRICS_DIR (env) if set.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+from typing import Dict
+
+
+METRICS_DIR = os.environ.get('METRICS_DIR') # no files if unset
+PROM_FILE = 'metrics.prom'
+RERUN_LOG = 'reruns.jsonl'
+
+
+class Metrics:
+    """stage -> count / total / max seconds, counter -> value"""
+    def __init__(self):
+        self.stages:Dict[str, list] = {} # stage -> [count, total_s, max_s]
+        self.counters:Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage:str, seconds:float) -> None:
+        with self.lock:
+            item = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += seconds
+            item[2] = max(item[2], seconds)
+
+    def count(self, name:str, n:float=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'stages': {stage: {'count': c, 'total_s': t, 'max_s': m} for stage, (c, t, m) in self.stages.items()},
+                    'counters': dict(self.counters)}
+
+
+METRICS = Metrics()
+_local = threading.local()
+
+
+def start_rerun() -> None:
+    """start collecting stages of this script run"""
+    _local.rerun = {}
+    _local.rerun_start = time.perf_counter()
+
+def rerun_stages() -> Dict[str, float]:
+    """stage -> seconds in the current rerun (nested stages are counted in their parents too)"""
+    return dict(getattr(_local, 'rerun', None) or {})
+
+def rerun_seconds() -> float:
+    start = getattr(_local, 'rerun_start', None)
+    return 0.0 if start is None else time.perf_counter() - start
+
+def observe(stage:str, seconds:float) -> None:
+    METRICS.observe(stage, seconds)
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is not None:
+        rerun[stage] = rerun.get(stage, 0.0) + seconds
+
+def count(name:str, n:float=1) -> None:
+    METRICS.count(name, n)
+
+@contextlib.contextmanager
+def timed(stage:str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+# export
+def _prom_name(name:str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+def prometheus_text(gauges:Dict[str, float]=None) -> str:
+    """totals (+ gauges, e.g. cache hit rates) in the Prometheus text format"""
+    data = METRICS.snapshot()
+    lines = ['# TYPE app_stage_seconds_total counter']
+    lines += [f'app_stage_seconds_total{{stage="{stage}"}} {item["total_s"]:.6f}' for stage, item in data['stages'].items()]
+    lines += ['# TYPE app_stage_calls_total counter']
+    lines += [f'app_stage_calls_total{{stage="{stage}"}} {item["count"]}' for stage, item in data['stages'].items()]
+    lines += ['# TYPE app_stage_seconds_max gauge']
+    lines += [f'app_stage_seconds_max{{stage="{stage}"}} {item["max_s"]:.6f}' for stage, item in data['stages'].items()]
+    for name, value in data['counters'].items():
+        lines += [f'# TYPE app_{_prom_name(name)}_total counter', f'app_{_prom_name(name)}_total {value}']
+    for name, value in (gauges or {}).items():
+        lines += [f'# TYPE app_{_prom_name(name)} gauge', f'app_{_prom_name(name)} {value}']
+    return '\n'.join(lines) + '\n'
+
+def export(page:str, gauges:Dict[str, float]=None, directory:str=METRICS_DIR) -> dict:
+    """record of the current rerun; written with the totals to directory if set"""
+    record = {'ts': time.time(), 'page': page, 'rerun_s': rerun_seconds(), 'stages': rerun_stages(), 'gauges': gauges or {}}
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, PROM_FILE)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as file:
+            file.write(prometheus_text(gauges))
+        os.replace(tmp, path)
+        with open(os.path.join(directory, RERUN_LOG), 'a') as file:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return record
@@ -1,62 +1,42 @@
 import datetime
 
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 
-from google_api import get_google_service, get_gs_table
-from google_api import GSPage
-
-from utilities import fig_line_area, fig_bar
-from utilities import st_multiselect_empty, date_eom, color_cur_prev
-from utilities import auth
-from utilities import set_bg_hack
-
-
-
-@st.cache
-def get_payments(payments_gs:GSPage) -> pd.DataFrame:
-    service = get_google_service(payments_gs.service_account_json, api='sheets')
-    df_payments = get_gs_table(service, payments_gs.gs_id, payments_gs.page_name)
-    df_payments['Дата'] = pd.to_datetime(df_payments['Дата'], format='%d.%m.%Y')
-    df_payments['date_eom'] = df_payments['Дата'].map(date_eom)
-    df_payments[['сумма', 'комиссия']] = df_payments[['сумма', 'комиссия']].replace(' ','', regex=True)
-    df_payments[['сумма', 'комиссия']] = df_payments[['сумма', 'комиссия']].replace(',','', regex=True)
-    df_payments[['сумма', 'комиссия']] = df_payments[['сумма', 'комиссия']].applymap(pd.to_numeric)
-    df_payments.columns = ['date', 'service', 'supplier', 'summ', 'commision',  'date_eom']
-    df_payments['summ_w_comm'] = df_payments[['summ', 'commision']].sum(skipna=True, axis=1)
-
-    df_payments.sort_values('date_eom', inplace=True)
-    df_payments['prev_summ'] = df_payments.groupby(['service', 'supplier'])['summ'].transform(lambda x: x.shift(1))
-    df_payments['prev_comm'] = df_payments.groupby(['service', 'supplier'])['commision'].transform(lambda x: x.shift(1))
-    df_payments['summ_w_comm']= df_payments.groupby(['service', 'supplier'])['summ_w_comm'].transform(lambda x: x.shift(1))
-    
-    df_payments['year'] = df_payments['date_eom'].map(lambda x: x.year)
-    df_payments['month_num'] = df_payments['date_eom'].map(lambda x: x.month)
-    df_payments['supplier_service'] = df_payments.apply(lambda x: f"{x['supplier']}_{x['service']}", axis=1)
-    df_payments['supplier_service_formated'] = df_payments.apply(lambda x: f"__:blue[{x['supplier']}]__  \n(_{x['service']}_)", axis=1)
-    return df_payments
-
-def graphics_set(flt_df:pd.DataFrame, metric_title:str, items:list=None) -> None:
+from rollups import PaymentsAggregates, month_slice
+from loaders import get_payments_index, start_prefetch
+from loaders import payments_gs as payments_source
+
+from common import fig_line_area, fig_bar
+from common import st_multiselect_empty, date_eom, color_cur_prev
+from common import auth
+from common import set_bg_hack
+from common import plotly_chart, report_rerun
+from metrics import start_rerun, timed
+
+
+start_rerun()
+
+
+def graphics_set(aggregates:PaymentsAggregates, metric_title:str, item:str=None) -> None:
+    """item: supplier_service, None -> total"""
     # metrics
-    if items:
-        flt_df = flt_df[flt_df['supplier_service'].isin(items)]
-    
-    df_metric = flt_df[['date_eom','summ', 'prev_summ']][flt_df['date_eom']==month_sel].groupby('date_eom').sum().sort_values('summ', ascending=False)
+    metric = aggregates.metric(item, month_sel)
     col1, col2 = st.columns([1,4])
     with col1:
-        if len(df_metric)==0:
+        if metric is None:
             st.markdown(f'**{metric_title}**  \nНет начислений в этом месяце')
         else:
+            summ, prev_summ = metric
             st.metric(metric_title, 
-                int(df_metric['summ']),
-                int(df_metric['summ'] - df_metric['prev_summ']),
+                int(summ),
+                int(summ - prev_summ),
                 delta_color="inverse")
     with col2:
         tab1, tab2, tab3, tab4 = st.tabs(['мес-год', 'год', 'ср.мес', 'сравнить годы'])
         with tab1:
-            df_fig =  flt_df[['date_eom','summ']].groupby('date_eom').sum()
-            fig = fig_line_area(df_fig.reset_index(), 
+            df_fig = aggregates.get(item, 'by_month')
+            fig = fig_line_area(df_fig, 
                         x='date_eom', 
                         y='summ', 
                         type='line', # line / area
@@ -64,10 +44,10 @@ def graphics_set(flt_df:pd.DataFrame, metric_title:str, items:list=None) -> None
                         xaxis_title='год-месяц', 
                         yaxis_title='руб.'
                         )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
         with tab2:
-            df_fig =  flt_df[['year','summ']].groupby('year').sum()
-            fig = fig_line_area(df_fig.reset_index(), 
+            df_fig = aggregates.get(item, 'by_year')
+            fig = fig_line_area(df_fig, 
                         x='year', 
                         y='summ', 
                         type='line', # line / area
@@ -76,11 +56,10 @@ def graphics_set(flt_df:pd.DataFrame, metric_title:str, items:list=None) -> None
                         yaxis_title='руб.',
                         line_color=None
                         )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
         with tab3:
-            df_fig =  flt_df[['month_num', 'year', 'summ']].groupby('month_num').agg({'summ':'sum', 'year':'nunique'})
-            df_fig['summ_mean'] = df_fig['summ'].div(df_fig['year'])
-            fig = fig_bar(df_fig.reset_index(), 
+            df_fig = aggregates.get(item, 'by_month_num')
+            fig = fig_bar(df_fig, 
                         x='month_num', 
                         y='summ_mean', 
                         barmode='relative',
@@ -89,10 +68,10 @@ def graphics_set(flt_df:pd.DataFrame, metric_title:str, items:list=None) -> None
                         yaxis_title='руб.',
                         marker_color=None
                         )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
         with tab4:
-            df_fig =  flt_df[['year','month_num', 'summ']].groupby(['year', 'month_num']).sum().reset_index()
-            fig = fig_line_area(df_fig.reset_index(), 
+            df_fig = aggregates.get(item, 'year_month')
+            fig = fig_line_area(df_fig, 
                         x='month_num', 
                         y='summ',
                         color='year', 
@@ -102,7 +81,7 @@ def graphics_set(flt_df:pd.DataFrame, metric_title:str, items:list=None) -> None
                         yaxis_title='руб.',
                         line_color=None
                         )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
     return None
 
 set_bg_hack('bg_payments.png')
@@ -114,20 +93,13 @@ else:
     st.session_state["add_phone_bills_show_form"]=False
 
 # set constants
-GOOGLESHEET_ID = st.secrets['GOOGLESHEET_ID']
-PAYMENTS_PAGE_ID = st.secrets['PAYMENTS_PAGE_ID']
-PAYMENTS_PAGE_NAME = st.secrets['PAYMENTS_PAGE_NAME']
-SERVICE_ACCOUNT_JSON = st.secrets['SERVICE_ACCOUNT_JSON']
+payments_gs = payments_source()
 
-payments_gs = GSPage(
-            service_account_json=SERVICE_ACCOUNT_JSON,
-            gs_id=GOOGLESHEET_ID,
-            page_id=PAYMENTS_PAGE_ID,
-            page_name=PAYMENTS_PAGE_NAME
-            )
+start_prefetch()
 
-df = get_payments(payments_gs)
-years = list(set(df['year']))
+payments = get_payments_index(payments_gs)
+df = payments.df
+years = payments.years()
 
 ################################################################################
 authenticator = auth()
@@ -145,7 +117,7 @@ with st.sidebar:
     st.markdown("***")
     st.write(f'[__Коммунальные платежи__](https://docs.google.com/spreadsheets/d/{payments_gs.gs_id}/edit#gid={payments_gs.page_id})')
     flt_year = st.slider("Период", min(years),  max(years), (max(years)-5,  max(years)))
-    flt_year_df = df[df['year'].between(flt_year[0], flt_year[1])]
+    flt_year_df = payments.in_years(flt_year)
     flt_supp = st_multiselect_empty(list(set(flt_year_df['supplier'])), title='Поставщики', default=None)
     flt_df = flt_year_df[flt_year_df['supplier'].isin(flt_supp)]
 
@@ -156,9 +128,11 @@ month_sel = datetime.datetime.combine(month_sel, datetime.datetime.min.time())
 st.info(f"на дату: __{month_sel.strftime('%d.%m.%Y')}__")
 
 
-graphics_set(flt_df, "**Всего**", items=None)
+with timed('aggregate'):
+    aggregates = PaymentsAggregates(flt_df)
+graphics_set(aggregates, "**Всего**", item=None)
 
-df_month = flt_df[['supplier', 'service', 'summ', 'summ_w_comm', 'prev_summ']][flt_df['date_eom']==month_sel].groupby(['supplier', 'service']).sum().sort_values('summ', ascending=False)
+df_month = month_slice(flt_df, month_sel)[['supplier', 'service', 'summ', 'summ_w_comm', 'prev_summ']].groupby(['supplier', 'service'], observed=True).sum().sort_values('summ', ascending=False)
 df_month['diff'] = df_month['summ'] - df_month['prev_summ']
 df_month['icon_diff'] = df_month['diff'].map(lambda x: f"↑{x:.2f}" if x>0 else f"↓{x:.2f}" if x<0 else '-')
 df_month['color_diff'] = df_month.apply(lambda x: color_cur_prev(x['summ'], x['prev_summ']), axis=1)
@@ -174,10 +148,8 @@ with col2:
 
 
 st.subheader('По поставщикам / услугам')
-supplier_service_list = (flt_df[['supplier_service', 'supplier_service_formated', 'date_eom','summ']]
-                .groupby(['supplier_service', 'supplier_service_formated'])
-                .sum()
-                .sort_values('summ', ascending=False)
-                .reset_index()[['supplier_service', 'supplier_service_formated']])
-for _,i,f in supplier_service_list.itertuples():
-    graphics_set(flt_df, f, items=[i])
+for i,f in aggregates.items():
+    graphics_set(aggregates, f, item=i)
+
+
+report_rerun('payments')
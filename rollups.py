@@ -0,0 +1,190 @@
+"""Pre-aggregated rollups, built once per data version
+
+Charts read slices of ready frames keyed by the year range of the "Период" slider.
+Frames of the loaders are sorted by date_eom: year ranges and months are binary-search slices.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def year_slice(df:pd.DataFrame, years:Tuple[int, int]) -> pd.DataFrame:
+    """rows of df (sorted by year) with years[0] <= year <= years[1], binary search"""
+    year = df['year'].values
+    lo = np.searchsorted(year, years[0], side='left')
+    hi = np.searchsorted(year, years[1], side='right')
+    return df.iloc[lo:hi]
+
+def month_slice(df:pd.DataFrame, month) -> pd.DataFrame:
+    """rows of df (sorted by date_eom) of month (end of month date), binary search"""
+    date_eom = df['date_eom'].values
+    month = np.datetime64(pd.Timestamp(month), 'ns')
+    lo = np.searchsorted(date_eom, month, side='left')
+    hi = np.searchsorted(date_eom, month, side='right')
+    return df.iloc[lo:hi]
+
+
+class MonthIndex:
+    """frame of a loader (sorted by date_eom): month -> rows by precomputed offsets,
+    (entity, month) -> first row of the entity in the month
+    """
+    def __init__(self, df:pd.DataFrame, key:str):
+        self.df = df
+        self.key = key
+        date_eom = df['date_eom'].values
+        starts = np.flatnonzero(np.r_[True, date_eom[1:] != date_eom[:-1]]) if len(df) else np.array([], dtype=int)
+        stops = np.r_[starts[1:], len(df)].astype(int)
+        self.offsets = {pd.Timestamp(date_eom[start]): (start, stop) for start, stop in zip(starts, stops)}
+        self.first = ~df.duplicated([key, 'date_eom']).values
+
+    def years(self) -> List[int]:
+        return sorted({month.year for month in self.offsets})
+
+    def in_years(self, years:Tuple[int, int]) -> pd.DataFrame:
+        return year_slice(self.df, years)
+
+    def month(self, month) -> pd.DataFrame:
+        start, stop = self.offsets.get(pd.Timestamp(month), (0, 0))
+        return self.df.iloc[start:stop]
+
+    def rows(self, month) -> pd.DataFrame:
+        """first row of every entity in month, indexed by the entity (str)"""
+        start, stop = self.offsets.get(pd.Timestamp(month), (0, 0))
+        rows = self.df.iloc[start + np.flatnonzero(self.first[start:stop])]
+        rows.index = rows[self.key].astype(str).values
+        return rows
+
+
+class MonthNumMeans:
+    """mean by month_num over any year range: cumulative sums/counts by year, O(12) per query"""
+    def __init__(self, df:pd.DataFrame, key:str, value:str):
+        self.key = key
+        self.value = value
+        self.keys = list(pd.unique(df[key])) if key else [None]
+        self.first_year = int(df['year'].min()) if len(df) else 0
+        n_years = int(df['year'].max()) - self.first_year + 1 if len(df) else 0
+        sums = np.zeros((len(self.keys), n_years + 1, 12))
+        counts = np.zeros((len(self.keys), n_years + 1, 12))
+        if len(df):
+            key_idx = pd.Categorical(df[key], categories=self.keys).codes if key else np.zeros(len(df), dtype=int)
+            year_idx = df['year'].values.astype(int) - self.first_year + 1
+            month_idx = df['month_num'].values.astype(int) - 1
+            values = df[value].values.astype(float)
+            notna = ~np.isnan(values)
+            np.add.at(sums, (key_idx[notna], year_idx[notna], month_idx[notna]), values[notna])
+            np.add.at(counts, (key_idx[notna], year_idx[notna], month_idx[notna]), 1)
+        self.sums = sums.cumsum(axis=1)
+        self.counts = counts.cumsum(axis=1)
+
+    def query(self, years:Tuple[int, int]) -> pd.DataFrame:
+        n_years = self.sums.shape[1] - 1
+        i0 = min(max(years[0] - self.first_year, 0), n_years)
+        i1 = min(max(years[1] - self.first_year + 1, 0), n_years)
+        sums = self.sums[:, i1] - self.sums[:, i0]
+        counts = self.counts[:, i1] - self.counts[:, i0]
+        key_idx, month_idx = np.nonzero(counts)
+        df = pd.DataFrame({'month_num': month_idx + 1, self.value: sums[key_idx, month_idx] / counts[key_idx, month_idx]})
+        if self.key:
+            df.insert(0, self.key, np.array(self.keys, dtype=object)[key_idx])
+        return df
+
+
+class MetersCube:
+    """(meter, year, month) -> consumption plus year / month-of-year rollups for every group of meters"""
+    def __init__(self, df_meters_by_month:pd.DataFrame, groups:Dict[str, List[str]]):
+        monthly = df_meters_by_month[['meter', 'date_eom', 'year', 'month_num', 'consumption', 'prev_consumption']].copy()
+        monthly['meter'] = monthly['meter'].astype(str)
+        monthly = monthly.sort_values(['date_eom', 'meter'], kind='stable').reset_index(drop=True)
+        self.months = monthly
+        self.groups = groups
+
+        meter_year = monthly.groupby(['meter', 'year'])['consumption'].sum().reset_index()
+        self.meter_year = meter_year.sort_values(['year', 'meter'], kind='stable').reset_index(drop=True)
+        self.meter_month_num = MonthNumMeans(monthly, 'meter', 'consumption')
+
+        self.group_month = {}
+        self.group_year = {}
+        self.group_month_num = {}
+        for group, meters in groups.items():
+            group_month = (monthly[monthly['meter'].isin(meters)]
+                            .groupby(['date_eom', 'year', 'month_num'])['consumption'].sum().reset_index())
+            self.group_month[group] = group_month
+            self.group_year[group] = group_month.groupby('year')['consumption'].sum().reset_index()
+            self.group_month_num[group] = MonthNumMeans(group_month, None, 'consumption')
+
+    def years(self) -> List[int]:
+        return sorted(set(self.months['year']))
+
+    def months_in(self, years:Tuple[int, int]) -> pd.DataFrame:
+        """all meters by month"""
+        return year_slice(self.months, years)
+
+    # group total
+    def by_month(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        return year_slice(self.group_month[group], years)
+
+    def by_year(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        return year_slice(self.group_year[group], years)
+
+    def by_month_num(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        return self.group_month_num[group].query(years)
+
+    # by meter of the group
+    def meters_by_month(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        df = year_slice(self.months, years)
+        return df[df['meter'].isin(self.groups[group])]
+
+    def meters_by_year(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        df = year_slice(self.meter_year, years)
+        return df[df['meter'].isin(self.groups[group])].sort_values('meter', kind='stable')
+
+    def meters_by_month_num(self, group:str, years:Tuple[int, int]) -> pd.DataFrame:
+        df = self.meter_month_num.query(years)
+        return df[df['meter'].isin(self.groups[group])].sort_values(['meter', 'month_num'], kind='stable')
+
+
+class PaymentsAggregates:
+    """every graphics_set series for every supplier_service and the total, one grouped pass over flt_df"""
+    TOTAL = None # key of the total
+
+    def __init__(self, flt_df:pd.DataFrame):
+        base = (flt_df.groupby(['supplier_service', 'date_eom', 'year', 'month_num'], observed=True)[['summ', 'prev_summ']]
+                    .sum().reset_index())
+        base['supplier_service'] = base['supplier_service'].astype(str)
+        total = base.groupby(['date_eom', 'year', 'month_num'])[['summ', 'prev_summ']].sum().reset_index()
+        total.insert(0, 'supplier_service', '')
+        base = pd.concat([base, total], ignore_index=True)
+        key = 'supplier_service'
+
+        self.formated = (flt_df[['supplier_service', 'supplier_service_formated']].drop_duplicates('supplier_service')
+                            .astype(str).set_index('supplier_service')['supplier_service_formated'].to_dict())
+        self.metrics = {(k, d): (s, p) for k, d, s, p in base[[key, 'date_eom', 'summ', 'prev_summ']].itertuples(index=False)}
+
+        by_year = base.groupby([key, 'year'])['summ'].sum().reset_index()
+        by_month_num = base.groupby([key, 'month_num']).agg(summ=('summ', 'sum'), year=('year', 'nunique')).reset_index()
+        by_month_num['summ_mean'] = by_month_num['summ'].div(by_month_num['year'])
+        self.ranking = by_year.groupby(key)['summ'].sum().drop('', errors='ignore').sort_values(ascending=False, kind='stable')
+
+        self.series = {}
+        for name, df in [('by_month', base[[key, 'date_eom', 'summ']]),
+                         ('by_year', by_year),
+                         ('by_month_num', by_month_num[[key, 'month_num', 'summ_mean']]),
+                         ('year_month', base[[key, 'year', 'month_num', 'summ']])]:
+            for k, group in df.groupby(key, sort=False):
+                self.series[(k, name)] = group.drop(columns=key).reset_index(drop=True)
+
+    def _key(self, item:str) -> str:
+        return '' if item is self.TOTAL else item
+
+    def metric(self, item:str, month:pd.Timestamp):
+        """(summ, prev_summ) of the month, None if no payments"""
+        return self.metrics.get((self._key(item), pd.Timestamp(month)))
+
+    def get(self, item:str, name:str) -> pd.DataFrame:
+        """by_month / by_year / by_month_num / year_month"""
+        return self.series.get((self._key(item), name), pd.DataFrame())
+
+    def items(self) -> List[Tuple[str, str]]:
+        """(supplier_service, supplier_service_formated) by total summ, descending"""
+        return [(k, self.formated[k]) for k in self.ranking.index]
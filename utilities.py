@@ -1,161 +1,21 @@
 import datetime
-import yaml
-import base64
 
-from dataclasses import dataclass
-from typing import List
-
-import pandas as pd
-import plotly.express as px
 import streamlit as st
-import streamlit_authenticator as stauth
-
-from google_api import get_google_service, get_gs_table
-from google_api import GSPage
-
-
-
-
 
-def date_eom(x:datetime):
-    return (x.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+from loaders import get_meters_cube, start_prefetch
+from loaders import METER_GROUPS
+from loaders import meters_gs as meters_source
+from rollups import month_slice
 
-def st_multiselect_empty(ser:pd.Series, title:str='', default:List[str]=None) -> List[str]:
-    group_sel = st.multiselect(title, list(set(ser)), default)
-    return set(ser) if not group_sel else group_sel
+from common import fig_line_area, fig_bar
+from common import date_eom
+from common import auth
+from common import set_bg_hack
+from common import plotly_chart, report_rerun
+from metrics import start_rerun
 
-def color_cur_prev(cur, prev):
-    color = 'green' if cur < prev else 'red' if cur > prev else 'grey'
-    return f'color: {color}'
-
-def fig_line_area(df:pd.DataFrame, 
-            x:str, 
-            y:str, 
-            type:str = 'line', # line / area
-            color:str=None, 
-            title:str='', 
-            line_color:str=None, 
-            line_colors:List[str]=[],
-            xaxis_title:str='', 
-            yaxis_title:str='',
-            hover_name:str=None,
-            markers=True
-            ):
-    
-    px_fig = px.line
-    if type == 'area':
-        px_fig = px.area
-
-    fig = px_fig(df, x=x, y=y, color=color, hover_name=hover_name, markers=markers)
-    if color and line_colors:
-        for i in  range(len(line_colors)):
-            fig['data'][i]['line']['color']=line_colors[i]
-    elif line_color: 
-        fig.update_traces(line_color=line_color)
-
-
-    fig.update_traces(marker=dict(size=4))
-
-    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
-    fig.update_yaxes(rangemode="tozero")
-
-    fig.update_layout({'plot_bgcolor': 'rgba(255, 255, 255, 0.3)',
-                        'paper_bgcolor': 'rgba(255, 255, 255, 0.2)',
-                     })
-
-    return fig
-
-def fig_bar(df:pd.DataFrame, 
-            x:str, 
-            y:str, 
-            color:str=None, 
-            title:str='', 
-            marker_color:str=None, 
-            color_discrete_map:dict=None,
-            xaxis_title:str='', 
-            yaxis_title:str='',
-            barmode:str='relative',
-            hover_name:str=None
-            ):
-
-    px_fig = px.bar
-    fig = px_fig(df, x=x, y=y, barmode=barmode, hover_name=hover_name)
-    if color:
-        fig = px_fig(df, x=x, y=y, color=color, barmode=barmode, hover_name=hover_name)
-        if color_discrete_map:
-            fig = px_fig(df, x=x, y=y, color=color, color_discrete_map=color_discrete_map, barmode=barmode, hover_name=hover_name)
-    elif marker_color: 
-           fig.update_traces(marker_color=marker_color)
-
-    fig.update_layout(title=title, xaxis_title=xaxis_title, yaxis_title=yaxis_title)
-    fig.update_yaxes(rangemode="tozero")
-    fig.update_layout({'plot_bgcolor': 'rgba(255, 255, 255, 0.3)',
-                    'paper_bgcolor': 'rgba(255, 255, 255, 0.2)',
-                    })
-    return fig
-
-
-
-def set_bg_hack(main_bg):
-    '''
-    A function to unpack an image from root folder and set as bg.
-
-    Returns
-    -------
-    The background.
-    '''
-    # set bg name
-    main_bg_ext = "png"
-        
-    st.markdown(
-         f"""
-         <style>
-         .stApp {{
-             background: url(data:image/{main_bg_ext};base64,{base64.b64encode(open(main_bg, "rb").read()).decode()});
-             background-size: cover
-         }}
-         </style>
-         """,
-         unsafe_allow_html=True
-     )
-
-
-@st.cache
-def get_meters(meters_gs:GSPage) -> pd.DataFrame:
-    service = get_google_service(meters_gs.service_account_json, api='sheets')
-    df_meters = get_gs_table(service, meters_gs.gs_id, meters_gs.page_name)
-    df_meters = df_meters[['Дата', 'счетчик', 'место', 'показания', 'потребление']]
-    df_meters['Дата'] = pd.to_datetime(df_meters['Дата'], format='%d.%m.%Y')
-    df_meters['date_eom'] = df_meters['Дата'].map(date_eom)
-    df_meters['показания'].replace(' ','', regex=True, inplace=True)
-    df_meters['показания'].replace(',','', regex=True, inplace=True)
-    df_meters['показания'] = df_meters['показания'].map(pd.to_numeric)
-    df_meters['потребление'] = df_meters['потребление'].map(pd.to_numeric)
-    
-    df_meters_by_month = pd.DataFrame(df_meters.groupby(['счетчик', 'date_eom']).agg({'показания':'max','потребление':'sum' })).reset_index().sort_values('date_eom')
-    df_meters_by_month.columns = ['meter', 'date_eom', 'value', 'consumption']
-    df_meters_by_month['prev_consumption'] = df_meters_by_month.groupby('meter')['consumption'].transform(lambda x: x.shift(1))
-    df_meters_by_month['year'] = df_meters_by_month['date_eom'].map(lambda x: x.year)
-    df_meters_by_month['month_num'] = df_meters_by_month['date_eom'].map(lambda x: x.month)
-    return df_meters_by_month
-
-def auth():
-    # auth
-    # https://blog.streamlit.io/streamlit-authenticator-part-1-adding-an-authentication-component-to-your-app/
-    with open('config.yaml') as file:
-        config = yaml.load(file, Loader=stauth.SafeLoader)
-
-        authenticator  = stauth.Authenticate(
-            config['credentials'],
-            config['cookie']['name'],
-            config['cookie']['key'],
-            config['cookie']['expiry_days'],
-            config['preauthorized']
-        )
-
-    st.session_state["name"], st.session_state["authentication_status"], st.session_state["username"] = authenticator.login('Войти', 'sidebar')
-    return authenticator
 
+start_rerun()
 st.set_page_config(page_title='Household', page_icon='🟡')
 set_bg_hack('bg_utilities.png')
 
@@ -176,29 +36,19 @@ if 'authenticator' not in st.session_state:
     st.session_state['authenticator'] = None
 
 # set constants
-GOOGLESHEET_ID = st.secrets['GOOGLESHEET_ID']
-METERS_PAGE_ID = st.secrets['METERS_PAGE_ID']
-METERS_PAGE_NAME = st.secrets['METERS_PAGE_NAME']
-SERVICE_ACCOUNT_JSON = st.secrets['SERVICE_ACCOUNT_JSON']
-
+meters_gs = meters_source()
 
-meters_gs = GSPage(
-            service_account_json=SERVICE_ACCOUNT_JSON,
-            gs_id=GOOGLESHEET_ID,
-            page_id=METERS_PAGE_ID,
-            page_name=METERS_PAGE_NAME
-            )
+# all loaders, in the background, once per process
+start_prefetch()
 
 
 # main
 
-df_meters_by_month = get_meters(meters_gs) 
+meters_cube = get_meters_cube(meters_gs)
 
-meters_water = ['ХВС', 'ГВС']
-meters_electricity = ['ЭЛ.ЭНЕРГИЯ']
-meters_gas = ['ГАЗ']
+meters_water = METER_GROUPS['water']
 
-years = list(set(df_meters_by_month['year']))
+years = meters_cube.years()
 
 st.title('Потребление ресурсов')
 
@@ -225,9 +75,7 @@ with st.sidebar:
 
 
 
-flt_year_meters_by_month = df_meters_by_month[df_meters_by_month['year'].between(flt_year[0], flt_year[1])]
-flt_year_meters_by_year = flt_year_meters_by_month.groupby(['meter', 'year'])['consumption'].sum().reset_index()
-flt_year_meters_by_month_num = flt_year_meters_by_month.groupby(['meter', 'month_num'])['consumption'].mean().reset_index()
+flt_year_meters_by_month = meters_cube.months_in(flt_year)
 
 st.subheader('За месяц')
 month_sel = st.date_input('выберете любую дату в рамках нужного месяца', 
@@ -238,15 +86,16 @@ month_sel = date_eom(month_sel)
 month_sel = datetime.datetime.combine(month_sel, datetime.datetime.min.time())
 st.info(f"на дату: __{month_sel.strftime('%d.%m.%Y')}__")
 
-df_last_month = flt_year_meters_by_month[flt_year_meters_by_month['date_eom'] == month_sel]
-meters_list = list(set(df_last_month['meter']))
+df_last_month = month_slice(flt_year_meters_by_month, month_sel)
+last_month = df_last_month.groupby('meter')[['consumption', 'prev_consumption']].max()
+meters_list = list(last_month.index)
 col = st.columns(len(meters_list))
 
 for i in range(len(meters_list)):
     with col[i]:
         st.metric(f'__{meters_list[i]}__' + ('  кВт' if meters_list[i]=='ЭЛ.ЭНЕРГИЯ' else '  куб.м'), 
-            int(max(df_last_month[df_last_month['meter']==meters_list[i]]['consumption'])), 
-            int(max(df_last_month[df_last_month['meter']==meters_list[i]]['consumption']) - max(df_last_month[df_last_month['meter']==meters_list[i]]['prev_consumption'])),
+            int(last_month['consumption'].iloc[i]), 
+            int(last_month['consumption'].iloc[i] - last_month['prev_consumption'].iloc[i]),
             delta_color="inverse")
 
 st.subheader('Динамика')
@@ -262,17 +111,17 @@ with tab1:
         line_color = marker_color ='blue'
 
         # df
-        flt_year_by_month = flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_water)].groupby(['date_eom', 'year','month_num'])['consumption'].sum().reset_index()
-        flt_year_by_year = flt_year_by_month.groupby('year')['consumption'].sum().reset_index()
-        flt_year_by_month_num = flt_year_by_month.groupby('month_num')['consumption'].mean().reset_index()
+        flt_year_by_month = meters_cube.by_month('water', flt_year)
+        flt_year_by_year = meters_cube.by_year('water', flt_year)
+        flt_year_by_month_num = meters_cube.by_month_num('water', flt_year)
         # charts
-        st.plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color,
+        plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color,
             title='общее потребление, по годам', xaxis_title='год', yaxis_title=yaxis_title))
-        st.plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color,
+        plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color,
             title='общее потребление, по месяцам', xaxis_title='год-месяц', yaxis_title=yaxis_title))
-        st.plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color, 
+        plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color, 
             title='среднее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))        
-        st.plotly_chart(fig_line_area(flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_water)].groupby(['year', 'month_num']).sum().reset_index(), 
+        plotly_chart(fig_line_area(flt_year_by_month, 
             x='month_num', y='consumption', color='year', type='line', 
             title='общее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))
 
@@ -288,41 +137,41 @@ with tab1:
         with col1:
             fig_type = st.radio('Вид', radio_opt)
             if fig_type == radio_opt[0]:
-                fig_type_by_year = fig_line_area(flt_year_meters_by_year[flt_year_meters_by_year['meter'].isin(meters_water)], x='year', y='consumption', type='area', color='meter',
+                fig_type_by_year = fig_line_area(meters_cube.meters_by_year('water', flt_year), x='year', y='consumption', type='area', color='meter',
                     title='суммарное потребление по видам, по годам', xaxis_title='год', yaxis_title=yaxis_title, line_colors=line_colors)
             else:
-                fig_type_by_year = fig_line_area(flt_year_meters_by_year[flt_year_meters_by_year['meter'].isin(meters_water)], x='year', y='consumption', type='line', color='meter',
+                fig_type_by_year = fig_line_area(meters_cube.meters_by_year('water', flt_year), x='year', y='consumption', type='line', color='meter',
                     title='суммарное потребление по видам, по годам', xaxis_title='год', yaxis_title=yaxis_title, line_colors=line_colors)
         with col2:
-            st.plotly_chart(fig_type_by_year)
+            plotly_chart(fig_type_by_year)
 
 
         col1, col2 = st.columns([1,5])
         with col1:
             fig_type = st.radio('Вид ', radio_opt)
             if fig_type == radio_opt[0]:
-                fig_type_by_month = fig_line_area(flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_water)], x='date_eom', y='consumption', type='area', color='meter',
+                fig_type_by_month = fig_line_area(meters_cube.meters_by_month('water', flt_year), x='date_eom', y='consumption', type='area', color='meter',
                 title='суммарное потребление по видам, по месяцам', xaxis_title='год-месяц', yaxis_title=yaxis_title, line_colors=line_colors)
             else:
-                fig_type_by_month = fig_line_area(flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_water)], x='date_eom', y='consumption', type='line', color='meter',
+                fig_type_by_month = fig_line_area(meters_cube.meters_by_month('water', flt_year), x='date_eom', y='consumption', type='line', color='meter',
                 title='суммарное потребление по видам, по месяцам', xaxis_title='год-месяц', yaxis_title=yaxis_title, line_colors=line_colors)
         with col2:
-            st.plotly_chart(fig_type_by_month)
+            plotly_chart(fig_type_by_month)
 
 
         col1, col2 = st.columns([1,5])
         with col1:
             fig_type = st.radio('Вид  ', radio_opt)
             if fig_type == radio_opt[0]:
-                fig_type_by_month_num = fig_bar(flt_year_meters_by_month_num[flt_year_meters_by_month_num['meter'].isin(meters_water)], x='month_num', y='consumption', color='meter',
+                fig_type_by_month_num = fig_bar(meters_cube.meters_by_month_num('water', flt_year), x='month_num', y='consumption', color='meter',
                     title='среднее потребление воды по видам, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title,
                     color_discrete_map=color_discrete_map)
             else:
-                fig_type_by_month_num = fig_bar(flt_year_meters_by_month_num[flt_year_meters_by_month_num['meter'].isin(meters_water)], x='month_num', y='consumption', color='meter',  barmode='group',
+                fig_type_by_month_num = fig_bar(meters_cube.meters_by_month_num('water', flt_year), x='month_num', y='consumption', color='meter',  barmode='group',
                     title='среднее потребление воды по видам, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title,
                     color_discrete_map=color_discrete_map)   
         with col2:
-            st.plotly_chart(fig_type_by_month_num)
+            plotly_chart(fig_type_by_month_num)
 
 
 
@@ -332,18 +181,18 @@ with tab2:
 
     st.subheader('Эл. энергия')
 
-    flt_year_by_month = flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_electricity)].groupby([ 'date_eom', 'year','month_num'])['consumption'].sum().reset_index()
-    flt_year_by_year = flt_year_by_month.groupby('year')['consumption'].sum().reset_index()
-    flt_year_by_month_num = flt_year_by_month.groupby('month_num')['consumption'].mean().reset_index()
+    flt_year_by_month = meters_cube.by_month('electricity', flt_year)
+    flt_year_by_year = meters_cube.by_year('electricity', flt_year)
+    flt_year_by_month_num = meters_cube.by_month_num('electricity', flt_year)
 
     # charts
-    st.plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color, 
+    plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color, 
         title='общее потребление, по годам', xaxis_title='год', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color, 
+    plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color, 
         title='общее потребление, по месяцам', xaxis_title='год-месяц', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color,
+    plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color,
         title='среднее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_line_area(flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_electricity)].groupby(['year', 'month_num']).sum().reset_index(), 
+    plotly_chart(fig_line_area(flt_year_by_month, 
         x='month_num', y='consumption', color='year', type='line', 
         title='общее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))
 
@@ -355,20 +204,20 @@ with tab3:
     
     st.subheader('Газ')
 
-    flt_year_by_month = flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_gas)].groupby(['date_eom', 'year','month_num'])['consumption'].sum().reset_index()
-    flt_year_by_year = flt_year_by_month.groupby('year')['consumption'].sum().reset_index()
-    flt_year_by_month_num = flt_year_by_month.groupby('month_num')['consumption'].mean().reset_index()
+    flt_year_by_month = meters_cube.by_month('gas', flt_year)
+    flt_year_by_year = meters_cube.by_year('gas', flt_year)
+    flt_year_by_month_num = meters_cube.by_month_num('gas', flt_year)
 
     # charts
-    st.plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color, 
+    plotly_chart(fig_line_area(flt_year_by_year, x='year', y='consumption', type='line', line_color=line_color, 
         title='общее потребление, по годам', xaxis_title='год', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color, 
+    plotly_chart(fig_line_area(flt_year_by_month, x='date_eom', y='consumption', type='line', line_color=line_color, 
         title='общее потребление, по месяцам', xaxis_title='год-месяц', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color,
+    plotly_chart(fig_bar(flt_year_by_month_num, x='month_num', y='consumption', marker_color=marker_color,
         title='среднее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))
-    st.plotly_chart(fig_line_area(flt_year_meters_by_month[flt_year_meters_by_month['meter'].isin(meters_gas)].groupby(['year', 'month_num']).sum().reset_index(), 
+    plotly_chart(fig_line_area(flt_year_by_month, 
         x='month_num', y='consumption', color='year', type='line', 
         title='общее потребление, по месяцам', xaxis_title='месяц', yaxis_title=yaxis_title))
 
 
-
+report_rerun('utilities')